@@ -0,0 +1,623 @@
+"""Performance benchmarks for the renderers and the spline evaluator.
+
+Times every engine over a matrix of resolutions, scene sizes and curve
+degrees, writes the results as JSON and optionally compares them against a
+stored baseline:
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json --threshold 0.2
+
+Exits with status 1 when any benchmark is slower than the baseline by more
+than the threshold. Runs headless, Qt is never imported. Ray rates count
+primary rays (one per pixel) except in the shadow suite, which times the
+any-hit occlusion query against a nearest hit query on the same shadow
+rays. Sample rates count emitted curve points, the mesh suite loads
+generated OBJ files and reports triangles per second. The precision and
+mesh suites also report peak memory, the precision suite the difference
+of float32 frames to float64 ones. The render suites use the Numba kernels
+when Numba is installed, the jit suite times them against the NumPy code
+and reports the first call of every kernel (compiling it or loading it
+from the disk cache). It is skipped without Numba (an error when asked
+for) and fails when a kernel frame is further than JIT_TOLERANCE from the
+NumPy one. The preview suite times every level of detail of a progressive
+frame from the start of the frame, next to a plain render.
+The relight suite re-shades a G-buffer after moving the light (shadow rays
+and shading) and after a material edit (shading only), next to tracing
+the frame again, for the NumPy and Whitted engines.
+"""
+
+import argparse
+import copy
+import json
+import platform
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+RENDER_SIZES = ((160, 90), (320, 180), (640, 360))
+# The recursive Vector3 tracer is orders of magnitude slower
+WHITTED_SIZES = ((32, 18), (64, 36))
+SCENE_SIZES = (10, 100, 1000, 10000)
+SCENE_RESOLUTION = (160, 90)
+PRECISION_SIZES = ((320, 180), (640, 360))
+PRUNING_THRESHOLDS = (0.01, 0.05, 0.2)
+SHADOW_RAYS = 20000
+RELIGHT_SCENE_SIZES = (1000, 10000)
+MESH_SIZES = (10_000, 100_000, 1_000_000)
+# Building the BVH of larger meshes takes most of a minute
+MESH_RENDER_LIMIT = 100_000
+CURVE_DEGREES = (2, 5, 14)
+# Largest difference of a kernel frame to the NumPy one the jit suite accepts
+JIT_TOLERANCE = 1e-9
+CURVE_SAMPLES = 100
+
+
+def measure(function, repeat):
+    """Best wall-clock time of 'repeat' runs"""
+
+    best = np.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def peak_memory(function):
+    """Peak bytes allocated while 'function' runs (NumPy reports to tracemalloc)"""
+
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def image_difference(image, reference):
+    """Max and RMS error, PSNR in dB and the fraction of pixels off by >1/255"""
+
+    error = np.asarray(image, dtype=np.float64) - reference
+    rmse = np.sqrt(np.mean(error**2))
+    return {
+        "max_error": float(np.abs(error).max()),
+        "rmse": float(rmse),
+        "psnr": float(20 * np.log10(1 / rmse)) if rmse > 0 else np.inf,
+        "pixels_changed": float(np.mean(np.abs(error).max(axis=-1) > 1 / 255)),
+    }
+
+
+def render_benchmarks(repeat):
+    from utils import raytracing, rt, wavefront
+
+    engines = (
+        ("numpy", raytracing.render_tile, (), RENDER_SIZES),
+        ("wavefront", wavefront.render_tile, (), RENDER_SIZES),
+        ("whitted", rt.render_tile, (), WHITTED_SIZES),
+    )
+    for engine, render_tile, args, sizes in engines:
+        for width, height in sizes:
+            seconds = measure(
+                lambda: render_tile(width, height, 0, 0, height, width, *args), repeat
+            )
+            yield {
+                "name": f"render/{engine}/{width}x{height}",
+                "seconds": seconds,
+                "rays_per_second": width * height / seconds,
+            }
+
+
+def scene_benchmarks(repeat):
+    from utils.raytracing import render_tile
+    from utils.scene import Scene
+
+    width, height = SCENE_RESOLUTION
+    for count in SCENE_SIZES:
+        for accelerated in (False, True):
+            scene = Scene.random(count)
+            if accelerated:
+                scene.build_bvh()
+            elif count > 1000:
+                continue
+
+            seconds = measure(
+                lambda: render_tile(width, height, 0, 0, height, width, 3, scene),
+                repeat,
+            )
+            yield {
+                "name": f"scene/{'bvh' if accelerated else 'brute'}/{count}",
+                "seconds": seconds,
+                "rays_per_second": width * height / seconds,
+            }
+
+
+def precision_benchmarks(repeat):
+    from utils import raytracing, wavefront
+    from utils.scene import Scene
+
+    engines = (
+        (
+            "numpy",
+            raytracing.render_tile,
+            lambda dtype: (3, Scene.from_objects(raytracing.objects, dtype)),
+        ),
+        (
+            "wavefront",
+            wavefront.render_tile,
+            lambda dtype: (wavefront.FOV, wavefront.WhittedScene(dtype=dtype)),
+        ),
+    )
+    for engine, render_tile, make_args in engines:
+        for width, height in PRECISION_SIZES:
+            reference = None
+            for dtype in (np.float64, np.float32):
+                args = make_args(dtype)
+
+                def render():
+                    return render_tile(width, height, 0, 0, height, width, *args)
+
+                seconds = measure(render, repeat)
+                result = {
+                    "name": f"precision/{engine}/{np.dtype(dtype)}/{width}x{height}",
+                    "seconds": seconds,
+                    "rays_per_second": width * height / seconds,
+                    "peak_bytes": peak_memory(render),
+                }
+                image = render()
+                if reference is None:
+                    reference = image
+                else:
+                    result.update(image_difference(image, reference))
+                yield result
+
+
+def pruning_benchmarks(repeat):
+    from utils import raytracing, rt, wavefront
+    from utils.pruning import RayPruning
+    from utils.stats import RenderStats
+
+    engines = (
+        ("numpy", raytracing.render_tile, RENDER_SIZES[1]),
+        ("wavefront", wavefront.render_tile, RENDER_SIZES[1]),
+        ("whitted", rt.render_tile, WHITTED_SIZES[1]),
+    )
+    configurations = [("all", None)] + [
+        (f"{mode}-{threshold}", RayPruning(threshold, mode == "roulette"))
+        for threshold in PRUNING_THRESHOLDS
+        for mode in ("cutoff", "roulette")
+    ]
+    for engine, render_tile, (width, height) in engines:
+        reference = None
+        for configuration, pruning in configurations:
+
+            def render(**kwargs):
+                return render_tile(
+                    width, height, 0, 0, height, width, pruning=pruning, **kwargs
+                )
+
+            stats = RenderStats()
+            render(stats=stats)
+            seconds = measure(render, repeat)
+            result = {
+                "name": f"pruning/{engine}/{configuration}",
+                "seconds": seconds,
+                "rays_per_second": width * height / seconds,
+                "traced_rays": int(sum(stats.rays.values())),
+            }
+            image = np.clip(render(), 0, 1)
+            if reference is None:
+                reference = image
+            else:
+                result.update(image_difference(image, reference))
+            yield result
+
+
+def jit_benchmarks(repeat):
+    from utils import jit, raytracing, rt
+
+    engines = (
+        ("numpy", raytracing.render_tile, RENDER_SIZES),
+        ("whitted", rt.render_tile, WHITTED_SIZES),
+    )
+    if not jit.available():
+        raise RuntimeError("the jit suite needs Numba to compare the kernels with")
+    enabled = jit.enabled()
+    try:
+        for engine, render_tile, sizes in engines:
+            for width, height in sizes:
+                reference = None
+                for mode in ("numpy", "numba"):
+                    jit.set_enabled(mode == "numba")
+
+                    def render():
+                        return render_tile(width, height, 0, 0, height, width)
+
+                    start = perf_counter()
+                    image = render()
+                    first = perf_counter() - start
+                    seconds = measure(render, repeat)
+                    result = {
+                        "name": f"jit/{engine}/{mode}/{width}x{height}",
+                        "seconds": seconds,
+                        "rays_per_second": width * height / seconds,
+                        "first_seconds": first,
+                    }
+                    if reference is None:
+                        reference = image
+                    else:
+                        result.update(image_difference(image, reference))
+                        if result["max_error"] > JIT_TOLERANCE:
+                            raise RuntimeError(
+                                f"{result['name']} differs from the NumPy frame "
+                                f"by {result['max_error']:.2e}"
+                            )
+                    yield result
+    finally:
+        jit.set_enabled(enabled)
+
+
+def preview_benchmarks(repeat):
+    from utils.backends import RayTracingBackend, WavefrontBackend, WhittedBackend
+    from utils.preview import render_levels
+
+    backends = (
+        ("numpy", RayTracingBackend(), PRECISION_SIZES[-1]),
+        ("wavefront", WavefrontBackend(), PRECISION_SIZES[-1]),
+        ("whitted", WhittedBackend(), WHITTED_SIZES[-1]),
+    )
+    for engine, backend, (width, height) in backends:
+        seconds = measure(lambda: backend.render(width, height), repeat)
+        yield {
+            "name": f"preview/{engine}/plain/{width}x{height}",
+            "seconds": seconds,
+            "rays_per_second": width * height / seconds,
+        }
+
+        levels = {}
+        for _ in range(repeat):
+            start = perf_counter()
+            for scale, _, done in render_levels(backend.render_samples, width, height):
+                if done:
+                    elapsed = perf_counter() - start
+                    levels[scale] = min(levels.get(scale, np.inf), elapsed)
+        for scale, seconds in levels.items():
+            yield {
+                "name": f"preview/{engine}/1-{scale}/{width}x{height}",
+                "seconds": seconds,
+                "rays_per_second": width * height / scale**2 / seconds,
+            }
+
+
+def relight_benchmarks(repeat):
+    from utils import raytracing
+    from utils.scene import Scene
+
+    width, height = PRECISION_SIZES[-1]
+    scenes = {"default": Scene.from_objects(raytracing.objects)}
+    for count in RELIGHT_SCENE_SIZES:
+        scenes[f"bvh-{count}"] = Scene.random(count)
+        scenes[f"bvh-{count}"].build_bvh()
+
+    position = raytracing.light["position"]
+    moved = position + np.array([-8, 1, -3])
+    try:
+        for name, scene in scenes.items():
+            edited = copy.copy(scene)
+            edited.diffuse = scene.diffuse[::-1].copy()
+            edited.reflection = scene.reflection * 0.5
+
+            def trace():
+                return raytracing.render_tile(
+                    width, height, 0, 0, height, width, 3, edited
+                )
+
+            def gbuffer():
+                return raytracing.render_gbuffer(width, height, 3, scene)
+
+            frame = gbuffer()
+            # alternate the light so that every run traces the shadow rays
+            positions = iter([position, moved] * (repeat + 1))
+
+            def move_light():
+                raytracing.light["position"] = next(positions)
+                return raytracing.shade_gbuffer(frame, edited)
+
+            runs = {
+                "trace": trace,
+                "gbuffer": gbuffer,
+                "light": move_light,
+                "material": lambda: raytracing.shade_gbuffer(frame, edited),
+            }
+            for run, function in runs.items():
+                seconds = measure(function, repeat)
+                result = {
+                    "name": f"relight/{name}/{run}/{width}x{height}",
+                    "seconds": seconds,
+                    "rays_per_second": width * height / seconds,
+                }
+                if run in ("light", "material"):
+                    image = function().reshape(height, width, 3)
+                    result.update(image_difference(image, trace()))
+                yield result
+    finally:
+        raytracing.light["position"] = position
+    yield from _relight_whitted(repeat)
+
+
+def _relight_whitted(repeat):
+    from utils import jit, rt
+
+    width, height = WHITTED_SIZES[-1]
+    lights = rt.LIGHTS
+    moved = (lights[0] + rt.Vector3(-8, 1, -3),) + lights[1:]
+    color = rt.IVORY.diffuse_color
+    enabled = jit.enabled()
+    # 'shade_gbuffer' gives the pixels of the NumPy code
+    jit.set_enabled(False)
+    try:
+        rt.IVORY.diffuse_color = rt.Vector3(0.1, 0.5, 0.2)
+
+        def trace():
+            return rt.render_tile(width, height, 0, 0, height, width)
+
+        def gbuffer():
+            return rt.trace_gbuffer(width, height, 0, 0, height, width)
+
+        frame = gbuffer()
+        # alternate the key light so that every run traces its shadow rays
+        positions = iter([lights, moved] * (repeat + 1))
+
+        def move_light():
+            rt.LIGHTS = next(positions)
+            return rt.shade_gbuffer(frame)
+
+        runs = {
+            "trace": trace,
+            "gbuffer": gbuffer,
+            "light": move_light,
+            "material": lambda: rt.shade_gbuffer(frame),
+        }
+        for run, function in runs.items():
+            seconds = measure(function, repeat)
+            result = {
+                "name": f"relight/whitted/{run}/{width}x{height}",
+                "seconds": seconds,
+                "rays_per_second": width * height / seconds,
+            }
+            if run in ("light", "material"):
+                result.update(image_difference(function(), trace()))
+            yield result
+    finally:
+        rt.LIGHTS = lights
+        rt.IVORY.diffuse_color = color
+        jit.set_enabled(enabled)
+
+
+def shadow_benchmarks(repeat):
+    from utils.raytracing import light
+    from utils.scene import Scene
+
+    # shadow rays from random points inside the scene bounds to the light
+    rng = np.random.default_rng(0)
+    origins = rng.uniform((-1.5, -1, -4), (1.5, 1, -1), (SHADOW_RAYS, 3))
+    directions = light["position"] - origins
+    distances = np.linalg.norm(directions, axis=1)
+    directions /= distances[:, np.newaxis]
+
+    for count in SCENE_SIZES:
+        for accelerated in (False, True):
+            scene = Scene.random(count)
+            if accelerated:
+                scene.build_bvh()
+            elif count > 1000:
+                continue
+
+            queries = {
+                "nearest": lambda: scene.intersect(origins, directions)[1] < distances,
+                "occluded": lambda: scene.occluded(origins, directions, distances),
+            }
+            for query, shadows in queries.items():
+                seconds = measure(shadows, repeat)
+                kind = "bvh" if accelerated else "brute"
+                yield {
+                    "name": f"shadow/{kind}/{count}/{query}",
+                    "seconds": seconds,
+                    "rays_per_second": SHADOW_RAYS / seconds,
+                }
+
+
+def write_grid_obj(path, triangles):
+    """A wavy height field of about 'triangles' triangles as an OBJ file"""
+
+    n = int(np.sqrt(triangles / 2)) + 1
+    x, z = np.meshgrid(np.linspace(-1, 1, n), np.linspace(-1, 1, n))
+    y = 0.1 * np.sin(6 * x) * np.cos(6 * z)
+    corner = (np.arange(n - 1)[:, np.newaxis] * n + np.arange(n - 1)).ravel() + 1
+    faces = np.concatenate(
+        (
+            np.stack((corner, corner + 1, corner + n), axis=1),
+            np.stack((corner + 1, corner + n + 1, corner + n), axis=1),
+        )
+    )
+    with open(path, "w") as file:
+        np.savetxt(
+            file, np.stack((x, y, z), axis=-1).reshape(-1, 3), "v %.6f %.6f %.6f"
+        )
+        np.savetxt(file, faces, "f %d %d %d")
+
+
+def mesh_benchmarks(repeat):
+    import os
+    import tempfile
+
+    from utils.backends import MESH_PLACEMENT
+    from utils.mesh import TriangleMesh, load_obj
+    from utils.raytracing import objects, render_tile
+    from utils.scene import Scene, SceneGroup
+
+    width, height = SCENE_RESOLUTION
+    with tempfile.TemporaryDirectory() as directory:
+        for count in MESH_SIZES:
+            path = os.path.join(directory, "mesh.obj")
+            write_grid_obj(path, count)
+            vertices, triangles = load_obj(path)
+            seconds = measure(lambda: load_obj(path), repeat)
+            yield {
+                "name": f"mesh/load/{len(triangles)}",
+                "seconds": seconds,
+                "triangles_per_second": len(triangles) / seconds,
+                "peak_bytes": peak_memory(lambda: load_obj(path)),
+            }
+            if count > MESH_RENDER_LIMIT:
+                continue
+
+            mesh = TriangleMesh(vertices, triangles).fitted(**MESH_PLACEMENT)
+            mesh.build_bvh()
+            scene = SceneGroup([Scene.from_objects(objects), mesh])
+            seconds = measure(
+                lambda: render_tile(width, height, 0, 0, height, width, 3, scene),
+                repeat,
+            )
+            yield {
+                "name": f"mesh/render/{len(triangles)}",
+                "seconds": seconds,
+                "rays_per_second": width * height / seconds,
+                "build_seconds": mesh.bvh.build_time,
+            }
+
+
+def spline_benchmarks(repeat):
+    import utils.splines as spl
+
+    rng = np.random.default_rng(0)
+    for degree in CURVE_DEGREES:
+        points = rng.normal(size=(degree + 1, 2)).tolist()
+        runs = 1000
+
+        seconds = measure(
+            lambda: [spl.bezier(points, CURVE_SAMPLES) for _ in range(runs)], repeat
+        )
+        yield {
+            "name": f"spline/bezier/degree-{degree}",
+            "seconds": seconds / runs,
+            "samples_per_second": CURVE_SAMPLES * runs / seconds,
+        }
+
+        vertices = len(spl.bezier_adaptive(points, 0.01))
+        seconds = measure(
+            lambda: [spl.bezier_adaptive(points, 0.01) for _ in range(runs // 10)],
+            repeat,
+        )
+        yield {
+            "name": f"spline/adaptive/degree-{degree}",
+            "seconds": seconds / (runs // 10),
+            "samples_per_second": vertices * (runs // 10) / seconds,
+        }
+
+
+SUITES = {
+    "jit": jit_benchmarks,
+    "mesh": mesh_benchmarks,
+    "precision": precision_benchmarks,
+    "preview": preview_benchmarks,
+    "pruning": pruning_benchmarks,
+    "relight": relight_benchmarks,
+    "render": render_benchmarks,
+    "scene": scene_benchmarks,
+    "shadow": shadow_benchmarks,
+    "spline": spline_benchmarks,
+}
+
+
+def compare(results, baseline, threshold):
+    """Names of benchmarks slower than the baseline by more than 'threshold'"""
+
+    previous = {result["name"]: result["seconds"] for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        if result["name"] not in previous:
+            continue
+        ratio = result["seconds"] / previous[result["name"]]
+        result["baseline_ratio"] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark renderers and splines")
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="allowed slowdown relative to the baseline, 0.2 = 20%%",
+    )
+    args = parser.parse_args(argv)
+
+    from utils import jit
+
+    suites = args.suite
+    if not suites:
+        suites = sorted(SUITES)
+        if not jit.available():
+            print("skipping the jit suite, Numba is not installed", file=sys.stderr)
+            suites.remove("jit")
+    elif "jit" in suites and not jit.available():
+        parser.error("the jit suite needs Numba, which is not installed")
+
+    results = []
+    for suite in suites:
+        for result in SUITES[suite](args.repeat):
+            results.append(result)
+            unit = next(key for key in result if key.endswith("_per_second"))
+            line = (
+                f"{result['name']:40} {result['seconds']:10.6f} s "
+                f"{result[unit]:14.0f} {unit.split('_')[0]}/s"
+            )
+            if "first_seconds" in result:
+                line += f"  first call {result['first_seconds']:.3f} s"
+            if "build_seconds" in result:
+                line += f"  BVH built in {result['build_seconds']:.3f} s"
+            if "traced_rays" in result:
+                line += f" {result['traced_rays']:10} rays traced"
+            if "peak_bytes" in result:
+                line += f" {result['peak_bytes'] / 2**20:8.1f} MiB"
+            if "psnr" in result:
+                line += (
+                    f"  max error {result['max_error']:.2e}, "
+                    f"PSNR {result['psnr']:.1f} dB, "
+                    f"{result['pixels_changed']:.3%} pixels changed"
+                )
+            print(line)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for name in regressions:
+            print(f"REGRESSION {name}")
+        status = 1 if regressions else 0
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                file,
+                indent=2,
+            )
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""Headless batch renderer.
+
+Renders every engine x size combination (or the jobs of a JSON file) to image
+files without importing Qt:
+
+    python render.py --engine numpy --engine wavefront --size 320x180 --size 1280x720
+    python render.py --jobs jobs.json
+    python render.py --engine whitted --relight 0,20,20 --relight 20,20,0
+
+A jobs file is a list of {"engine": ..., "width": ..., "height": ..., "output": ...}
+"""
+
+import argparse
+import json
+import os
+import sys
+from time import perf_counter
+
+START = perf_counter()
+
+import numpy as np
+
+from utils import jit
+from utils.backends import (
+    ExternalBackend,
+    RayTracingBackend,
+    TileBackend,
+    WavefrontBackend,
+    WhittedBackend,
+)
+from utils.imageio import open_image, save_image
+
+ENGINES = {
+    "numpy": RayTracingBackend,
+    "wavefront": WavefrontBackend,
+    "whitted": WhittedBackend,
+    "external": ExternalBackend,
+}
+DEFAULT_OUTPUT = "{engine}_{width}x{height}.ppm"
+
+
+def parse_size(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_position(position):
+    x, y, z = position.split(",")
+    return float(x), float(y), float(z)
+
+
+def make_jobs(args):
+    if args.jobs:
+        with open(args.jobs) as file:
+            jobs = json.load(file)
+        for job in jobs:
+            job.setdefault("output", DEFAULT_OUTPUT)
+        return jobs
+
+    return [
+        {"engine": engine, "width": width, "height": height, "output": args.output}
+        for engine in args.engine or ["numpy"]
+        for width, height in map(parse_size, args.size or ["320x180"])
+    ]
+
+
+def make_backend(job, tile_size, dtype=np.float64, mesh=None):
+    engine = ENGINES[job["engine"]]
+    if mesh is not None:
+        return engine(tile_size, dtype, mesh)
+    if len(engine.precisions) > 1:
+        return engine(tile_size, dtype)
+    if issubclass(engine, TileBackend):
+        return engine(tile_size)
+    return engine()
+
+
+def render_job(
+    job,
+    path,
+    workers,
+    tile_size,
+    stats=None,
+    cache=None,
+    dtype=np.float64,
+    antialias=None,
+    pruning=None,
+    mesh=None,
+):
+    """Render a job to 'path', returns the render and save times in seconds.
+
+    Without a cache PPM and PNG files are written tile by tile while the
+    frame renders, the save time is then None
+    """
+
+    backend = make_backend(job, tile_size, dtype, mesh)
+    if stats is not None and isinstance(backend, TileBackend):
+        backend.stats = stats
+        # instrumented frames must actually be rendered
+        cache = None
+    if antialias is not None:
+        backend.antialias = antialias
+    if pruning is not None:
+        backend.pruning = pruning
+    width, height = job["width"], job["height"]
+    # stats and anti-aliasing counters only exist in this process
+    parallel = (
+        workers != 1
+        and stats is None
+        and antialias is None
+        and isinstance(backend, TileBackend)
+    )
+
+    start = perf_counter()
+    if cache is None and path.lower().endswith((".ppm", ".png")):
+        if parallel:
+            from utils.parallel import render_parallel
+
+            with open_image(path, width, height) as writer:
+                render_parallel(
+                    backend.render_tile,
+                    width,
+                    height,
+                    backend.args,
+                    workers=workers,
+                    tile_size=tile_size,
+                    writer=writer,
+                    kwargs=backend.options(),
+                )
+        else:
+            backend.render_to_file(path, width, height)
+        return perf_counter() - start, None
+
+    key = None if cache is None else backend.cache_key(width, height)
+    image = None if key is None else cache.get(key)
+    if image is None and parallel:
+        from utils.parallel import render_parallel
+
+        image = render_parallel(
+            backend.render_tile,
+            width,
+            height,
+            backend.args,
+            workers=workers,
+            tile_size=tile_size,
+            kwargs=backend.options(),
+        )
+    elif image is None:
+        image = backend.render(width, height)
+    if key is not None:
+        cache.put(key, image)
+    render_time = perf_counter() - start
+
+    start = perf_counter()
+    save_image(path, image)
+    return render_time, perf_counter() - start
+
+
+def relight_job(
+    job, path, positions, tile_size, dtype=np.float64, pruning=None, mesh=None
+):
+    """Render the G-buffer of a job and re-shade it with the key light at every position.
+
+    The frames go next to 'path' with a _light1, _light2... suffix. Returns
+    the G-buffer time and (shading time, path) of every frame
+    """
+
+    backend = make_backend(job, tile_size, dtype, mesh)
+    backend.pruning = pruning
+    width, height = job["width"], job["height"]
+    start = perf_counter()
+    gbuffer = backend.render_gbuffer(width, height)
+    gbuffer_time = perf_counter() - start
+
+    root, extension = os.path.splitext(path)
+    frames = []
+    for number, position in enumerate(positions, 1):
+        start = perf_counter()
+        image = backend.relight(gbuffer, width, height, position)
+        shade_time = perf_counter() - start
+        frame_path = f"{root}_light{number}{extension}"
+        save_image(frame_path, image)
+        frames.append((shade_time, frame_path))
+    return gbuffer_time, frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render scenes to image files")
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES))
+    parser.add_argument("--size", action="append", help="WIDTHxHEIGHT")
+    parser.add_argument("--jobs", help="JSON file with a list of jobs")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=DEFAULT_OUTPUT,
+        help="output path, may use {engine}, {width} and {height}",
+    )
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="count rays and tests, save a per-pixel cost heatmap next to the image",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=("float64", "float32"),
+        default="float64",
+        help="float type of rays and shading, for the numpy and wavefront engines",
+    )
+    parser.add_argument(
+        "--aa",
+        action="store_true",
+        help="adaptive anti-aliasing of edge pixels, for the numpy and wavefront engines",
+    )
+    parser.add_argument(
+        "--min-contribution",
+        type=float,
+        help="terminate secondary rays that contribute less to their pixel",
+    )
+    parser.add_argument(
+        "--roulette",
+        action="store_true",
+        help="unbiased Russian roulette instead of cutting rays off, "
+        "needs --min-contribution",
+    )
+    parser.add_argument(
+        "--obj",
+        metavar="PATH",
+        help="add the triangle mesh of a Wavefront OBJ file, for the numpy engine",
+    )
+    parser.add_argument(
+        "--no-jit",
+        action="store_true",
+        help="render with the NumPy code even when Numba is installed",
+    )
+    parser.add_argument(
+        "--relight",
+        action="append",
+        metavar="X,Y,Z",
+        type=parse_position,
+        help="also save the frame with the key light moved to X,Y,Z, re-shaded from "
+        "a G-buffer without anti-aliasing, for the numpy and whitted engines",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="reuse frames of unchanged jobs from a render cache in DIR",
+    )
+    args = parser.parse_args(argv)
+    if args.roulette and args.min_contribution is None:
+        parser.error("--roulette needs --min-contribution")
+    if args.no_jit:
+        jit.set_enabled(False)
+
+    pruning = None
+    if args.min_contribution is not None:
+        from utils.pruning import RayPruning
+
+        pruning = RayPruning(args.min_contribution, args.roulette)
+
+    cache = None
+    if args.cache:
+        from utils.cache import RenderCache
+
+        cache = RenderCache(directory=args.cache)
+
+    print(f"startup: {perf_counter() - START:.3f} s")
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = make_jobs(args)
+    for job in jobs:
+        if np.dtype(args.precision) not in map(
+            np.dtype, ENGINES[job["engine"]].precisions
+        ):
+            parser.error(f"the {job['engine']} engine only renders in float64")
+        if args.aa and not ENGINES[job["engine"]].antialiasing:
+            parser.error(f"the {job['engine']} engine does not anti-alias")
+        if args.obj and not ENGINES[job["engine"]].meshes:
+            parser.error(f"the {job['engine']} engine does not render meshes")
+        if args.relight and not ENGINES[job["engine"]].relighting:
+            parser.error(f"the {job['engine']} engine does not relight")
+
+    mesh = None
+    if args.obj:
+        from utils.backends import load_mesh
+
+        start = perf_counter()
+        mesh = load_mesh(args.obj, args.precision)
+        print(
+            f"mesh: {len(mesh)} triangles, {mesh.nbytes / 2**20:.1f} MiB, "
+            f"loaded in {perf_counter() - start - mesh.bvh.build_time:.3f} s, "
+            f"BVH built in {mesh.bvh.build_time:.3f} s"
+        )
+
+    for job in jobs:
+        path = os.path.join(args.output_dir, job["output"].format(**job))
+        stats = None
+        if args.stats:
+            from utils.stats import RenderStats
+
+            stats = RenderStats(job["width"], job["height"])
+        antialias = None
+        if args.aa:
+            from utils.antialias import AdaptiveAA
+
+            antialias = AdaptiveAA()
+        try:
+            render_time, save_time = render_job(
+                job,
+                path,
+                args.workers,
+                args.tile_size,
+                stats,
+                cache,
+                args.precision,
+                antialias,
+                pruning,
+                mesh,
+            )
+        except RuntimeError as error:
+            # e.g. the external renderer is missing
+            print(f"{job['engine']}: {error}", file=sys.stderr)
+            return 1
+
+        save = "streamed" if save_time is None else f"save {save_time:.3f} s"
+        print(
+            f"{job['engine']} {job['width']}x{job['height']}: "
+            f"render {render_time:.3f} s, {save} -> {path}"
+        )
+        if stats is not None:
+            heatmap = os.path.splitext(path)[0] + ".cost.ppm"
+            save_image(heatmap, stats.heatmap())
+            print(stats.report())
+            print(f"cost heatmap -> {heatmap}")
+        if antialias is not None and antialias.pixels:
+            print(antialias.report())
+        if args.relight:
+            gbuffer_time, frames = relight_job(
+                job,
+                path,
+                args.relight,
+                args.tile_size,
+                args.precision,
+                pruning,
+                mesh,
+            )
+            print(f"g-buffer {gbuffer_time:.3f} s")
+            for shade_time, frame_path in frames:
+                print(f"relight {shade_time:.3f} s -> {frame_path}")
+    if cache is not None:
+        print(cache.report())
+    print(f"total: {perf_counter() - START:.3f} s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
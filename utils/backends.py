@@ -0,0 +1,321 @@
+import shlex
+import subprocess
+import sys
+
+import numpy as np
+
+from utils import jit
+from utils.cache import content_hash
+from utils.parallel import DEFAULT_TILE_SIZE, tiles
+
+# Must write a binary PPM (P6) frame of the requested size to stdout
+EXTERNAL_COMMAND = "../RayTracing/build/Debug/tinyraytracer {width} {height}"
+# Where an OBJ mesh goes in the default scene: right of the big sphere, on the floor
+MESH_PLACEMENT = {"size": 0.6, "center": (0.55, 0, -0.6), "floor": -0.7}
+
+
+class RenderBackend:
+    """Source of rendered frames.
+
+    'render_tiles' yields (top, left, tile) with float RGB tiles as soon as
+    they are ready, so frames can be shown progressively
+    """
+
+    name = ""
+    # float dtypes the backend can render in, the frames have the first one
+    precisions = (np.float64,)
+    # whether an AdaptiveAA can be set as 'antialias'
+    antialiasing = False
+    # whether a TriangleMesh can be added to the scene with 'mesh'
+    meshes = False
+    # whether 'render_samples' renders single pixels, for previews
+    previews = False
+    # whether 'relight' re-shades the G-buffer of a frame with a moved light
+    relighting = False
+
+    def __init__(self):
+        self.dtype = np.dtype(self.precisions[0])
+
+    def render_tiles(self, width, height):
+        # no per-frame state is kept here, workers of overlapping frames
+        # share the backend
+        yield from self._render_tiles(width, height)
+
+    def _render_tiles(self, width, height):
+        raise NotImplementedError
+
+    def render_samples(self, width, height, rows, cols):
+        """(N, 3) colors of the pixels at (rows, cols) of a width x height frame"""
+
+        raise NotImplementedError
+
+    def render_gbuffer(self, width, height):
+        """G-buffer of a width x height frame, for 'relight'"""
+
+        raise NotImplementedError
+
+    def relight(self, gbuffer, width, height, position):
+        """(height, width, 3) frame of a G-buffer with the key light moved to 'position'.
+
+        Only shadow rays are traced, anti-aliasing is left out
+        """
+
+        raise NotImplementedError
+
+    def describe(self):
+        """Everything but the frame size that the pixels depend on, None if unknown"""
+
+        return None
+
+    def cache_key(self, width, height):
+        """Content hash of a frame for a RenderCache, None if it can't be cached"""
+
+        description = self.describe()
+        if description is None:
+            return None
+        return content_hash(type(self).__name__, width, height, description)
+
+    def render(self, width, height, cache=None):
+        """Render a whole frame and return it as a (height, width, 3) array.
+
+        With a RenderCache a cached frame is returned (read-only) when there
+        is one, otherwise the new frame is added to it
+        """
+
+        key = None if cache is None else self.cache_key(width, height)
+        if key is not None:
+            image = cache.get(key)
+            if image is not None:
+                return image
+
+        image = np.zeros((height, width, 3), dtype=self.dtype)
+        for top, left, tile in self.render_tiles(width, height):
+            image[top : top + tile.shape[0], left : left + tile.shape[1]] = tile
+
+        if key is not None:
+            cache.put(key, image)
+        return image
+
+    def render_to_file(self, path, width, height):
+        """Write a frame to a .ppm or .png file tile by tile as the tiles finish"""
+
+        from utils.imageio import open_image
+
+        with open_image(path, width, height) as writer:
+            for top, left, tile in self.render_tiles(width, height):
+                writer.write(top, left, tile[: height - top, : width - left])
+
+
+class TileBackend(RenderBackend):
+    """In-process engine exposing a module level 'render_tile' function"""
+
+    def __init__(
+        self, render_tile, args=(), tile_size=DEFAULT_TILE_SIZE, render_samples=None
+    ):
+        super().__init__()
+
+        self.render_tile = render_tile
+        # module level 'render_samples(width, height, rows, cols, *args, **kwargs)'
+        # of backends with 'previews'
+        self._render_samples = render_samples
+        self.args = args
+        self.tile_size = tile_size
+        # RenderStats to instrument the next frames with, None to disable
+        self.stats = None
+        # AdaptiveAA for backends with 'antialiasing', None to disable
+        self.antialias = None
+        # RayPruning to terminate low contribution rays with, None to disable
+        self.pruning = None
+
+    def options(self):
+        """Keyword arguments of 'render_tile' that can be sent to other processes"""
+
+        return {} if self.pruning is None else {"pruning": self.pruning}
+
+    def describe(self):
+        module = self.render_tile.__module__
+        engine = sys.modules[module]
+        description = module, engine.ENGINE_VERSION, self.args
+        # compiled kernels round differently than the NumPy code
+        if getattr(engine, "JIT_KERNELS", False) and jit.enabled():
+            description += ("jit",)
+        for option in (self.antialias, self.pruning):
+            if option is not None:
+                description += (option,)
+        return description
+
+    def render_samples(self, width, height, rows, cols):
+        return self._render_samples(
+            width, height, rows, cols, *self.args, **self.options()
+        )
+
+    def _render_tiles(self, width, height):
+        kwargs = self.options()
+        if self.stats is not None:
+            kwargs["stats"] = self.stats
+        if self.antialias is not None:
+            kwargs["antialias"] = self.antialias
+        for top, left, bottom, right in tiles(width, height, self.tile_size):
+            yield top, left, self.render_tile(
+                width, height, top, left, bottom, right, *self.args, **kwargs
+            )
+
+
+class RayTracingBackend(TileBackend):
+    name = "NumPy ray tracer"
+    precisions = (np.float64, np.float32)
+    antialiasing = True
+    meshes = True
+    previews = True
+    relighting = True
+
+    def __init__(self, tile_size=DEFAULT_TILE_SIZE, dtype=np.float64, mesh=None):
+        from utils.raytracing import objects, render_samples, render_tile
+        from utils.scene import Scene, SceneGroup
+
+        scene = Scene.from_objects(objects, dtype)
+        if mesh is not None:
+            scene = SceneGroup([scene, mesh])
+        super().__init__(render_tile, (3, scene), tile_size, render_samples)
+        self.dtype = scene.dtype
+
+    def describe(self):
+        from utils.raytracing import camera, light
+
+        return super().describe() + (light, camera)
+
+    def render_gbuffer(self, width, height):
+        from utils.raytracing import render_gbuffer
+
+        return render_gbuffer(width, height, *self.args)
+
+    def relight(self, gbuffer, width, height, position):
+        from utils.raytracing import light, shade_gbuffer
+
+        moved = dict(light, position=np.array(position, dtype=float))
+        rng = None if self.pruning is None else self.pruning.generator(0, 0)
+        colors = shade_gbuffer(gbuffer, self.args[1], moved, self.pruning, rng)
+        return colors.reshape(height, width, 3)
+
+
+def load_mesh(path, dtype=np.float64):
+    """TriangleMesh of an OBJ file placed in the default scene, with a BVH"""
+
+    from utils.mesh import TriangleMesh
+
+    mesh = TriangleMesh.from_obj(path, dtype).fitted(**MESH_PLACEMENT)
+    mesh.build_bvh()
+    return mesh
+
+
+class WhittedBackend(TileBackend):
+    name = "Whitted ray tracer (rt.py)"
+    previews = True
+    relighting = True
+
+    def __init__(self, tile_size=DEFAULT_TILE_SIZE):
+        from utils.rt import render_samples, render_tile
+
+        super().__init__(
+            render_tile, tile_size=tile_size, render_samples=render_samples
+        )
+
+    def describe(self):
+        from utils.rt import FOV
+        from utils.wavefront import WhittedScene
+
+        return super().describe() + (FOV, WhittedScene())
+
+    def render_gbuffer(self, width, height):
+        from utils.rt import trace_gbuffer
+
+        return trace_gbuffer(width, height, 0, 0, height, width)
+
+    def relight(self, gbuffer, width, height, position):
+        from utils.rt import LIGHTS, Vector3, shade_gbuffer
+
+        return shade_gbuffer(gbuffer, (Vector3(*position),) + LIGHTS[1:], self.pruning)
+
+
+class WavefrontBackend(TileBackend):
+    name = "Wavefront Whitted ray tracer"
+    precisions = (np.float64, np.float32)
+    antialiasing = True
+    previews = True
+
+    def __init__(self, tile_size=DEFAULT_TILE_SIZE, dtype=np.float64):
+        from utils.wavefront import FOV, WhittedScene, render_samples, render_tile
+
+        scene = WhittedScene(dtype=dtype)
+        super().__init__(render_tile, (FOV, scene), tile_size, render_samples)
+        self.dtype = scene.dtype
+
+
+class ExternalBackend(RenderBackend):
+    """Runs an external renderer and reads raw pixels from its stdout.
+
+    The frame never touches the disk: rows are decoded straight from the
+    pipe and yielded in bands as they arrive
+    """
+
+    name = "External tinyraytracer"
+
+    def __init__(self, command=EXTERNAL_COMMAND, rows_per_band=16):
+        super().__init__()
+
+        self.command = command
+        self.rows_per_band = rows_per_band
+
+    def _render_tiles(self, width, height):
+        command_line = self.command.format(width=width, height=height)
+        try:
+            process = subprocess.Popen(
+                shlex.split(command_line), stdout=subprocess.PIPE
+            )
+        except OSError as error:
+            raise RuntimeError(
+                f"external renderer not found: {command_line} ({error.strerror})"
+            ) from error
+        with process:
+            try:
+                yield from read_ppm_rows(process.stdout, self.rows_per_band)
+            finally:
+                process.kill()
+
+
+def _read_ppm_token(stream):
+    token = b""
+    while True:
+        char = stream.read(1)
+        if not char:
+            break
+        if char == b"#":
+            stream.readline()
+            continue
+        if char.isspace():
+            if token:
+                break
+            continue
+        token += char
+    return token
+
+
+def read_ppm_rows(stream, rows_per_band=16):
+    """Decode a binary PPM from a stream, yielding (top, 0, rows) float bands"""
+
+    if _read_ppm_token(stream) != b"P6":
+        raise ValueError("Only binary PPM (P6) frames are supported")
+    width, height, maxval = (int(_read_ppm_token(stream)) for _ in range(3))
+    dtype = np.dtype(np.uint8 if maxval < 256 else ">u2")
+
+    row_size = width * 3 * dtype.itemsize
+    for top in range(0, height, rows_per_band):
+        rows = min(rows_per_band, height - top)
+        data = stream.read(row_size * rows)
+        if len(data) != row_size * rows:
+            raise ValueError("Unexpected end of PPM stream")
+        band = np.frombuffer(data, dtype=dtype).reshape(rows, width, 3)
+        yield top, 0, band / maxval
+
+
+BACKENDS = (RayTracingBackend, WavefrontBackend, WhittedBackend, ExternalBackend)
@@ -0,0 +1,288 @@
+from time import perf_counter
+
+import numpy as np
+
+# Relative costs used by the surface area heuristic
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+
+
+def _half_area(lo, hi):
+    extent = np.maximum(hi - lo, 0)
+    return (
+        extent[..., 0] * extent[..., 1]
+        + extent[..., 1] * extent[..., 2]
+        + extent[..., 2] * extent[..., 0]
+    )
+
+
+def _inverse(directions):
+    with np.errstate(divide="ignore"):
+        return 1 / np.where(directions == 0, 1e-30, directions)
+
+
+class BVH:
+    """Bounding volume hierarchy over axis aligned primitive bounds.
+
+    Built top-down with the binned surface area heuristic and stored as flat
+    arrays: interior nodes keep the index of their left child (the right one
+    follows it), leaves keep a range of 'order'. Traversal runs over packets
+    of rays, every node is tested against all rays that reached it at once.
+    Node bounds are stored in 'dtype', rounded outwards so they still enclose
+    their primitives
+    """
+
+    def __init__(self, lo, hi, leaf_size=4, bins=16, dtype=np.float64):
+        self.leaf_size = leaf_size
+        self.bins = bins
+        self.dtype = np.dtype(dtype)
+
+        start = perf_counter()
+        self._build(np.asarray(lo, dtype=float), np.asarray(hi, dtype=float))
+        self.build_time = perf_counter() - start
+
+        self.reset_stats()
+
+    def _build(self, lo, hi):
+        count = len(lo)
+        centroids = (lo + hi) / 2
+        self.order = np.arange(count)
+
+        node_lo, node_hi, node_first, node_count, node_axis = [], [], [], [], []
+
+        def allocate():
+            node_lo.append(None)
+            node_hi.append(None)
+            node_first.append(0)
+            node_count.append(0)
+            node_axis.append(0)
+            return len(node_lo) - 1
+
+        self.depth = 0
+        stack = [(allocate(), 0, count, 1)]
+        while stack:
+            node, start, end, depth = stack.pop()
+            self.depth = max(self.depth, depth)
+
+            primitives = self.order[start:end]
+            node_lo[node] = lo[primitives].min(axis=0)
+            node_hi[node] = hi[primitives].max(axis=0)
+
+            split = None
+            if end - start > self.leaf_size:
+                split = self._binned_sah(
+                    lo[primitives],
+                    hi[primitives],
+                    centroids[primitives],
+                    node_lo[node],
+                    node_hi[node],
+                )
+            if split is None:
+                node_first[node] = start
+                node_count[node] = end - start
+                continue
+
+            axis, left_mask = split
+            self.order[start:end] = np.concatenate(
+                (primitives[left_mask], primitives[~left_mask])
+            )
+            middle = start + np.count_nonzero(left_mask)
+
+            left, right = allocate(), allocate()
+            node_first[node] = left
+            node_axis[node] = axis
+            stack.append((left, start, middle, depth + 1))
+            stack.append((right, middle, end, depth + 1))
+
+        self.node_lo = np.nextafter(
+            np.array(node_lo).astype(self.dtype), self.dtype.type(-np.inf)
+        )
+        self.node_hi = np.nextafter(
+            np.array(node_hi).astype(self.dtype), self.dtype.type(np.inf)
+        )
+        self.node_first = np.array(node_first)
+        self.node_count = np.array(node_count)
+        self.node_axis = np.array(node_axis)
+
+    def _binned_sah(self, lo, hi, centroids, box_lo, box_hi):
+        """Best split of a node as (axis, mask of primitives going left) or None"""
+
+        count = len(lo)
+        parent_area = _half_area(box_lo, box_hi)
+        best_cost = count * INTERSECTION_COST
+        best = None
+
+        c_min, c_max = centroids.min(axis=0), centroids.max(axis=0)
+        for axis in range(3):
+            extent = c_max[axis] - c_min[axis]
+            if extent <= 0:
+                continue
+
+            bin_index = (
+                (centroids[:, axis] - c_min[axis]) / extent * self.bins
+            ).astype(int)
+            np.minimum(bin_index, self.bins - 1, out=bin_index)
+
+            bin_count = np.bincount(bin_index, minlength=self.bins)
+            bin_lo = np.full((self.bins, 3), np.inf)
+            bin_hi = np.full((self.bins, 3), -np.inf)
+            np.minimum.at(bin_lo, bin_index, lo)
+            np.maximum.at(bin_hi, bin_index, hi)
+
+            # candidate split i puts bins [0, i] to the left
+            left_count = np.cumsum(bin_count)[:-1]
+            right_count = count - left_count
+            left_area = _half_area(
+                np.minimum.accumulate(bin_lo)[:-1], np.maximum.accumulate(bin_hi)[:-1]
+            )
+            right_area = _half_area(
+                np.minimum.accumulate(bin_lo[::-1])[::-1][1:],
+                np.maximum.accumulate(bin_hi[::-1])[::-1][1:],
+            )
+            with np.errstate(invalid="ignore"):
+                cost = TRAVERSAL_COST + INTERSECTION_COST * (
+                    left_area * left_count + right_area * right_count
+                ) / max(parent_area, 1e-300)
+            cost[(left_count == 0) | (right_count == 0)] = np.inf
+
+            i = np.argmin(cost)
+            if cost[i] < best_cost:
+                best_cost = cost[i]
+                best = (axis, bin_index <= i)
+        return best
+
+    @property
+    def node_total(self):
+        return len(self.node_count)
+
+    @property
+    def leaf_total(self):
+        return int(np.count_nonzero(self.node_count))
+
+    def reset_stats(self):
+        self.stats = {"rays": 0, "node_tests": 0, "primitive_tests": 0}
+
+    def report(self):
+        """Human readable build and traversal statistics"""
+
+        rays = max(self.stats["rays"], 1)
+        return (
+            f"BVH: {len(self.order)} primitives, {self.node_total} nodes, "
+            f"{self.leaf_total} leaves, depth {self.depth}, "
+            f"built in {self.build_time:.3f} s; "
+            f"{self.stats['rays']} rays, "
+            f"{self.stats['node_tests'] / rays:.1f} node tests/ray, "
+            f"{self.stats['primitive_tests'] / rays:.1f} primitive tests/ray"
+        )
+
+    def intersect(self, ray_origins, ray_directions, primitive_distances, cost=None):
+        """Nearest primitive for every ray.
+
+        'primitive_distances(origins, directions, primitives)' must return a
+        (rays, primitives) array of hit distances with inf for misses. Returns
+        index of the nearest primitive (-1 when nothing is hit) and the
+        distance to it (inf when nothing is hit). Node and primitive tests
+        spent on every ray are added to 'cost' if given
+        """
+
+        count = len(ray_origins)
+        nearest = np.full(count, -1)
+        min_distance = np.full(count, np.inf, dtype=ray_directions.dtype)
+        self.stats["rays"] += count
+        if count == 0 or len(self.order) == 0:
+            return nearest, min_distance
+
+        inverse = _inverse(ray_directions)
+        stack = [(0, np.arange(count))]
+        while stack:
+            node, rays = stack.pop()
+            rays = self._enter(node, rays, ray_origins, inverse, min_distance, cost)
+            if len(rays) == 0:
+                continue
+
+            first = self.node_first[node]
+            if self.node_count[node]:
+                primitives = self.order[first : first + self.node_count[node]]
+                self.stats["primitive_tests"] += len(rays) * len(primitives)
+                if cost is not None:
+                    cost[rays] += len(primitives)
+
+                distances = primitive_distances(
+                    ray_origins[rays], ray_directions[rays], primitives
+                )
+                index = np.argmin(distances, axis=1)
+                distance = distances[np.arange(len(rays)), index]
+                closer = distance < min_distance[rays]
+                nearest[rays[closer]] = primitives[index[closer]]
+                min_distance[rays[closer]] = distance[closer]
+                continue
+
+            self._push_children(stack, node, rays, ray_directions)
+        return nearest, min_distance
+
+    def occluded(
+        self, ray_origins, ray_directions, primitive_distances, max_distance, cost=None
+    ):
+        """Whether every ray hits any primitive closer than its 'max_distance'.
+
+        Any-hit traversal for shadow rays: a ray leaves the traversal at the
+        first primitive that blocks it, nodes are culled against
+        'max_distance' instead of the nearest hit so far. Arguments as for
+        'intersect', 'max_distance' has one distance per ray
+        """
+
+        count = len(ray_origins)
+        blocked = np.zeros(count, dtype=bool)
+        self.stats["rays"] += count
+        if count == 0 or len(self.order) == 0:
+            return blocked
+
+        inverse = _inverse(ray_directions)
+        stack = [(0, np.arange(count))]
+        while stack:
+            node, rays = stack.pop()
+            rays = rays[~blocked[rays]]
+            rays = self._enter(node, rays, ray_origins, inverse, max_distance, cost)
+            if len(rays) == 0:
+                continue
+
+            first = self.node_first[node]
+            if self.node_count[node]:
+                primitives = self.order[first : first + self.node_count[node]]
+                self.stats["primitive_tests"] += len(rays) * len(primitives)
+                if cost is not None:
+                    cost[rays] += len(primitives)
+
+                distances = primitive_distances(
+                    ray_origins[rays], ray_directions[rays], primitives
+                )
+                hit = (distances < max_distance[rays, np.newaxis]).any(axis=1)
+                blocked[rays[hit]] = True
+                continue
+
+            self._push_children(stack, node, rays, ray_directions)
+        return blocked
+
+    def _enter(self, node, rays, ray_origins, inverse, limit, cost):
+        """The 'rays' that enter the bounds of 'node' closer than their 'limit'"""
+
+        self.stats["node_tests"] += len(rays)
+        if cost is not None:
+            cost[rays] += 1
+
+        t0 = (self.node_lo[node] - ray_origins[rays]) * inverse[rays]
+        t1 = (self.node_hi[node] - ray_origins[rays]) * inverse[rays]
+        t_near = np.maximum(np.minimum(t0, t1).max(axis=1), 0)
+        t_far = np.maximum(t0, t1).min(axis=1)
+        return rays[(t_near <= t_far) & (t_near < limit[rays])]
+
+    def _push_children(self, stack, node, rays, ray_directions):
+        # visit the child that most rays enter first, it is pushed last
+        first = self.node_first[node]
+        axis = self.node_axis[node]
+        if ray_directions[rays, axis].sum() >= 0:
+            stack.append((first + 1, rays))
+            stack.append((first, rays))
+        else:
+            stack.append((first, rays))
+            stack.append((first + 1, rays))
@@ -0,0 +1,183 @@
+import hashlib
+import os
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+DEFAULT_MEMORY_BUDGET = 256 << 20
+DEFAULT_DISK_BUDGET = 2 << 30
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "raytracing")
+
+
+def _update(digest, value):
+    if hasattr(value, "content"):
+        digest.update(type(value).__name__.encode())
+        value = value.content()
+
+    if isinstance(value, np.ndarray):
+        digest.update(b"a%s%s" % (value.dtype.str.encode(), repr(value.shape).encode()))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b"d%d" % len(value))
+        for key in sorted(value):
+            _update(digest, key)
+            _update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"l%d" % len(value))
+        for item in value:
+            _update(digest, item)
+    elif value is None or isinstance(value, (bool, int, float, str, np.generic)):
+        digest.update(b"s" + repr(value).encode())
+    else:
+        raise TypeError(f"Cannot hash {type(value).__name__} for the render cache")
+
+
+def content_hash(*parts):
+    """sha256 hex digest of arrays, numbers, strings and nested containers of them.
+
+    Objects with a 'content()' method are hashed by what it returns
+    """
+
+    digest = hashlib.sha256()
+    _update(digest, parts)
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """Rendered frames by content hash, in memory and optionally on disk.
+
+    Both tiers are bounded by a byte budget and evict the least recently used
+    frames first. Disk frames are .npy files that are memory-mapped when read,
+    so they survive restarts and cost no copy until their pixels are touched.
+    Cached frames are read-only views shared with every caller
+    """
+
+    def __init__(
+        self,
+        memory_budget=DEFAULT_MEMORY_BUDGET,
+        directory=None,
+        disk_budget=DEFAULT_DISK_BUDGET,
+    ):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.directory = directory
+
+        # key -> frame / file size, least recently used first
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+
+        self.hits = Counter()
+        self.misses = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._scan()
+
+    def _scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.disk
+
+    def get(self, key):
+        """Cached frame for 'key' or None"""
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits["memory"] += 1
+            return self.memory[key]
+
+        if key in self.disk:
+            path = self._path(key)
+            try:
+                frame = np.load(path, mmap_mode="r")
+            except OSError:
+                self._forget(key)
+            else:
+                # the modification time orders the files across restarts
+                os.utime(path)
+                self.disk.move_to_end(key)
+                self.hits["disk"] += 1
+                self._remember(key, frame)
+                return frame
+
+        self.misses += 1
+        return None
+
+    def put(self, key, frame):
+        """Cache 'frame', which must not be modified afterwards"""
+
+        frame = np.asarray(frame).view()
+        frame.flags.writeable = False
+        self._remember(key, frame)
+
+        if self.directory is not None and key not in self.disk:
+            if frame.nbytes > self.disk_budget:
+                return
+            path = self._path(key)
+            temporary = path + ".tmp"
+            with open(temporary, "wb") as file:
+                np.save(file, frame)
+            os.replace(temporary, path)
+
+            self.disk[key] = os.path.getsize(path)
+            self.disk_bytes += self.disk[key]
+            while self.disk_bytes > self.disk_budget:
+                self._forget(next(iter(self.disk)))
+
+    def _remember(self, key, frame):
+        if frame.nbytes > self.memory_budget:
+            return
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key).nbytes
+        self.memory[key] = frame
+        self.memory_bytes += frame.nbytes
+        while self.memory_bytes > self.memory_budget:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+
+    def _forget(self, key):
+        self.disk_bytes -= self.disk.pop(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_bytes = 0
+        for key in list(self.disk):
+            self._forget(key)
+
+    @property
+    def hit_rate(self):
+        lookups = sum(self.hits.values()) + self.misses
+        return sum(self.hits.values()) / lookups if lookups else 0.0
+
+    def report(self):
+        """One line summary of hits and memory/disk usage"""
+
+        line = (
+            f"render cache: {self.hits['memory']} memory hits, "
+            f"{self.hits['disk']} disk hits, {self.misses} misses "
+            f"({self.hit_rate:.0%} hit rate), "
+            f"memory {self.memory_bytes / 2**20:.1f}/{self.memory_budget / 2**20:.0f} MiB"
+        )
+        if self.directory is not None:
+            line += (
+                f", disk {self.disk_bytes / 2**20:.1f}/"
+                f"{self.disk_budget / 2**20:.0f} MiB"
+            )
+        return line
@@ -0,0 +1,160 @@
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COMPRESSION = 6
+
+
+def to_uint8(image):
+    return (np.clip(image, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+class ImageWriter:
+    """Writes a frame to a file tile by tile as the tiles are rendered.
+
+    Only tiles are converted to 8 bit, the float frame is never needed, so
+    the memory used does not grow with the frame size. Can be used as a
+    context manager that closes the file
+    """
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width = width
+        self.height = height
+
+    def write(self, top, left, tile):
+        """Store a float RGB tile in [0, 1] at (top, left)"""
+
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PPMWriter(ImageWriter):
+    """Binary PPM memory-mapped at its full size, tiles may come in any order.
+
+    Pixels that were not written yet stay black, so an interrupted render
+    leaves a valid file with every finished tile in it
+    """
+
+    def __init__(self, path, width, height):
+        super().__init__(path, width, height)
+
+        header = b"P6\n%d %d\n255\n" % (width, height)
+        with open(path, "wb") as file:
+            file.write(header)
+            file.truncate(len(header) + width * height * 3)
+        self.pixels = np.memmap(
+            path, np.uint8, "r+", offset=len(header), shape=(height, width, 3)
+        )
+
+    def write(self, top, left, tile):
+        height, width = tile.shape[:2]
+        self.pixels[top : top + height, left : left + width] = to_uint8(tile)
+
+    def close(self):
+        if self.pixels is not None:
+            self.pixels.flush()
+            self.pixels = None
+
+
+def _png_chunk(kind, data):
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)))
+    )
+
+
+class PNGWriter(ImageWriter):
+    """8 bit RGB PNG encoded on the fly with zlib.
+
+    PNG stores rows top to bottom, so a row is compressed as soon as all of
+    its tiles arrived and only incomplete rows are kept in memory, which for
+    row-major tiles is a single band of them. Every finished band is flushed
+    as an IDAT chunk, an interrupted render leaves a truncated PNG that
+    lenient decoders show down to the last finished band
+    """
+
+    def __init__(self, path, width, height, compression=PNG_COMPRESSION):
+        super().__init__(path, width, height)
+
+        self.file = open(path, "wb")
+        self.file.write(PNG_SIGNATURE)
+        self.file.write(
+            _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        )
+        self._compressor = zlib.compressobj(compression)
+        # row -> (filter byte + RGB pixels, number of pixels written)
+        self._pending = {}
+        self._next_row = 0
+
+    def write(self, top, left, tile):
+        height, width = tile.shape[:2]
+        pixels = to_uint8(tile)
+        for row in range(top, top + height):
+            if row not in self._pending:
+                self._pending[row] = [np.zeros(1 + self.width * 3, np.uint8), 0]
+            line = self._pending[row]
+            line[0][1 + left * 3 : 1 + (left + width) * 3] = pixels[row - top].ravel()
+            line[1] += width
+
+        data = []
+        while self._pending.get(self._next_row, (None, 0))[1] == self.width:
+            line, _ = self._pending.pop(self._next_row)
+            data.append(self._compressor.compress(line.tobytes()))
+            self._next_row += 1
+        if data:
+            data.append(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.file.write(_png_chunk(b"IDAT", b"".join(data)))
+            self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        # rows that never arrived are left black
+        empty = np.zeros(1 + self.width * 3, np.uint8).tobytes()
+        data = []
+        for row in range(self._next_row, self.height):
+            line = self._pending.pop(row, None)
+            data.append(self._compressor.compress(empty if line is None else line[0]))
+        data.append(self._compressor.flush())
+        self.file.write(_png_chunk(b"IDAT", b"".join(data)))
+        self.file.write(_png_chunk(b"IEND", b""))
+        self.file.close()
+        self.file = None
+
+
+def open_image(path, width, height):
+    """ImageWriter for 'path', PPM and PNG are supported"""
+
+    extension = str(path).lower().rsplit(".", 1)[-1]
+    if extension == "ppm":
+        return PPMWriter(path, width, height)
+    if extension == "png":
+        return PNGWriter(path, width, height)
+    raise ValueError(f"Only .ppm and .png images can be written, not {path}")
+
+
+def save_image(path, image):
+    """Save a float RGB image, PPM and PNG are written directly, others by matplotlib"""
+
+    if str(path).lower().endswith((".ppm", ".png")):
+        height, width = image.shape[:2]
+        with open_image(path, width, height) as writer:
+            writer.write(0, 0, image)
+        return
+
+    import matplotlib.pyplot as plt
+
+    plt.imsave(path, np.clip(image, 0, 1))
@@ -0,0 +1,47 @@
+import os
+import sys
+import threading
+from functools import lru_cache
+from importlib.util import find_spec
+
+# Set to "0" to render with the NumPy code even when Numba is installed
+JIT_VARIABLE = "RAYTRACING_JIT"
+# Held by the engines while a kernel runs. Without TBB or OpenMP, Numba
+# falls back to its workqueue threading layer, which aborts the process
+# when two threads launch parallel kernels at once, as the render threads
+# of the widget do when a cancelled worker is still finishing its tile
+KERNEL_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def available():
+    """Whether Numba is installed, without importing it"""
+
+    return find_spec("numba") is not None
+
+
+def enabled():
+    """Whether the engines use the compiled kernels of utils.kernels.
+
+    Decided at every call, so JIT_VARIABLE can be changed at runtime. The
+    kernels, and with them Numba, are only imported by engines that use them
+    """
+
+    return os.environ.get(JIT_VARIABLE, "1") != "0" and available()
+
+
+def set_enabled(flag):
+    """Switch the compiled kernels on or off for this and child processes"""
+
+    os.environ[JIT_VARIABLE] = "1" if flag else "0"
+
+
+def set_threads(count):
+    """Threads of the parallel kernels, for processes that already split a frame"""
+
+    if "numba" in sys.modules:
+        sys.modules["numba"].set_num_threads(
+            min(count, sys.modules["numba"].config.NUMBA_NUM_THREADS)
+        )
+    else:
+        os.environ["NUMBA_NUM_THREADS"] = str(count)
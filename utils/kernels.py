@@ -0,0 +1,398 @@
+"""Numba kernels for the NumPy ('raytracing') and Whitted ('rt') engines.
+
+Importing this module needs Numba, engines only do so when utils.jit says
+the kernels are enabled. Every kernel traces one ray (or one pixel) per
+loop iteration with scalar arithmetic, so nothing is allocated per bounce,
+and runs the loop over rays in parallel threads. Compiled code is cached
+on disk next to this file (or in NUMBA_CACHE_DIR), a launch after the
+first loads it instead of compiling again
+"""
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+_OPTIONS = {"cache": True, "error_model": "numpy"}
+
+
+@njit(parallel=True, **_OPTIONS)
+def primary_rays(width, height, top, left, bottom, right, camera, origins, directions):
+    """Fill (N, 3) 'origins' and 'directions' like 'raytracing.primary_rays'"""
+
+    ratio = width / height
+    x_step = 2 / max(width - 1, 1)
+    y_step = -2 / ratio / max(height - 1, 1)
+    columns = right - left
+    for ray in prange((bottom - top) * columns):
+        row, column = top + ray // columns, left + ray % columns
+        # like np.linspace, the last pixel lands exactly on the screen edge
+        x = 1.0 if column == width - 1 > 0 else -1 + column * x_step
+        y = -1 / ratio if row == height - 1 > 0 else 1 / ratio + row * y_step
+
+        dx, dy, dz = x - camera[0], y - camera[1], -camera[2]
+        norm = math.sqrt(dx * dx + dy * dy + dz * dz)
+        directions[ray, 0] = dx / norm
+        directions[ray, 1] = dy / norm
+        directions[ray, 2] = dz / norm
+        origins[ray, 0] = camera[0]
+        origins[ray, 1] = camera[1]
+        origins[ray, 2] = camera[2]
+
+
+@njit(**_OPTIONS)
+def _sphere_distance(ox, oy, oz, dx, dy, dz, center, center_term):
+    """Distance along a ray to a sphere as in 'Scene', inf for a miss"""
+
+    b = 2 * (
+        (dx * ox + dy * oy + dz * oz)
+        - (dx * center[0] + dy * center[1] + dz * center[2])
+    )
+    c = (
+        (ox * ox + oy * oy + oz * oz)
+        - 2 * (ox * center[0] + oy * center[1] + oz * center[2])
+        + center_term
+    )
+    delta = b * b - 4 * c
+    if delta <= 0:
+        return np.inf
+    q = -0.5 * (b + math.copysign(math.sqrt(delta), b))
+    t1, t2 = max(q, c / q), min(q, c / q)
+    if t1 > 0 and t2 > 0:
+        return t2
+    return np.inf
+
+
+@njit(parallel=True, **_OPTIONS)
+def trace_spheres(
+    origins,
+    directions,
+    max_depth,
+    centers,
+    center_term,
+    material_index,
+    ambient,
+    diffuse,
+    specular,
+    shininess,
+    reflection,
+    light_position,
+    eye,
+    epsilon,
+    min_contribution,
+    colors,
+    hit_ids,
+):
+    """'raytracing.trace_rays' for a 'Scene' without BVH, one ray per iteration.
+
+    'ambient', 'diffuse' and 'specular' are already multiplied by the light.
+    Writes clipped colors and the sphere every ray hits first (-1 for none),
+    rays stop bouncing once their reflection is zero or below
+    'min_contribution'
+    """
+
+    for ray in prange(len(origins)):
+        ox, oy, oz = origins[ray, 0], origins[ray, 1], origins[ray, 2]
+        dx, dy, dz = directions[ray, 0], directions[ray, 1], directions[ray, 2]
+        red = green = blue = 0.0
+        weight = 1.0
+        hit_ids[ray] = -1
+
+        for depth in range(max_depth):
+            nearest, distance = -1, np.inf
+            for sphere in range(len(centers)):
+                t = _sphere_distance(
+                    ox, oy, oz, dx, dy, dz, centers[sphere], center_term[sphere]
+                )
+                if t < distance:
+                    nearest, distance = sphere, t
+            if depth == 0:
+                hit_ids[ray] = nearest
+            if nearest < 0:
+                break
+
+            px, py, pz = ox + distance * dx, oy + distance * dy, oz + distance * dz
+            nx = px - centers[nearest, 0]
+            ny = py - centers[nearest, 1]
+            nz = pz - centers[nearest, 2]
+            norm = math.sqrt(nx * nx + ny * ny + nz * nz)
+            nx, ny, nz = nx / norm, ny / norm, nz / norm
+            sx, sy, sz = px + epsilon * nx, py + epsilon * ny, pz + epsilon * nz
+
+            lx = light_position[0] - sx
+            ly = light_position[1] - sy
+            lz = light_position[2] - sz
+            norm = math.sqrt(lx * lx + ly * ly + lz * lz)
+            lx, ly, lz = lx / norm, ly / norm, lz / norm
+
+            # any-hit shadow test up to the light
+            to_light_x = light_position[0] - px
+            to_light_y = light_position[1] - py
+            to_light_z = light_position[2] - pz
+            light_distance = math.sqrt(
+                to_light_x * to_light_x
+                + to_light_y * to_light_y
+                + to_light_z * to_light_z
+            )
+            shadowed = False
+            for sphere in range(len(centers)):
+                t = _sphere_distance(
+                    sx, sy, sz, lx, ly, lz, centers[sphere], center_term[sphere]
+                )
+                if t < light_distance:
+                    shadowed = True
+                    break
+            if shadowed:
+                break
+
+            material = material_index[nearest]
+            lambert = lx * nx + ly * ny + lz * nz
+
+            cx, cy, cz = eye[0] - px, eye[1] - py, eye[2] - pz
+            norm = math.sqrt(cx * cx + cy * cy + cz * cz)
+            hx, hy, hz = lx + cx / norm, ly + cy / norm, lz + cz / norm
+            norm = math.sqrt(hx * hx + hy * hy + hz * hz)
+            highlight = (nx * hx + ny * hy + nz * hz) / norm
+            highlight = highlight ** (shininess[material] / 4)
+
+            red += weight * (
+                ambient[material, 0]
+                + diffuse[material, 0] * lambert
+                + specular[material, 0] * highlight
+            )
+            green += weight * (
+                ambient[material, 1]
+                + diffuse[material, 1] * lambert
+                + specular[material, 1] * highlight
+            )
+            blue += weight * (
+                ambient[material, 2]
+                + diffuse[material, 2] * lambert
+                + specular[material, 2] * highlight
+            )
+
+            weight *= reflection[material]
+            if weight <= 0 or weight < min_contribution:
+                break
+            ox, oy, oz = sx, sy, sz
+            along = 2 * (dx * nx + dy * ny + dz * nz)
+            dx, dy, dz = dx - along * nx, dy - along * ny, dz - along * nz
+
+        colors[ray, 0] = min(max(red, 0.0), 1.0)
+        colors[ray, 1] = min(max(green, 0.0), 1.0)
+        colors[ray, 2] = min(max(blue, 0.0), 1.0)
+
+
+@njit(**_OPTIONS)
+def _push(rays, index, ox, oy, oz, dx, dy, dz, weight, depth):
+    rays[index, 0], rays[index, 1], rays[index, 2] = ox, oy, oz
+    rays[index, 3], rays[index, 4], rays[index, 5] = dx, dy, dz
+    rays[index, 6], rays[index, 7] = weight, depth
+
+
+@njit(**_OPTIONS)
+def _whitted_hit(ox, oy, oz, dx, dy, dz, centers, radii, max_distance):
+    """Nearest object of 'rt.scene_intersect' as (distance, sphere index).
+
+    The index is -1 for the plane and -2 when nothing is closer than
+    'max_distance'
+    """
+
+    nearest, distance = -2, 1e10
+    if abs(dy) > 0.001:
+        d = -(oy + 4) / dy
+        px, pz = ox + dx * d, oz + dz * d
+        if d > 0.001 and abs(px) < 10 and pz < -10 and pz > -30:
+            nearest, distance = -1, d
+
+    for sphere in range(len(centers)):
+        lx, ly, lz = (
+            centers[sphere, 0] - ox,
+            centers[sphere, 1] - oy,
+            centers[sphere, 2] - oz,
+        )
+        tca = lx * dx + ly * dy + lz * dz
+        d2 = lx * lx + ly * ly + lz * lz - tca * tca
+        if d2 > radii[sphere] ** 2:
+            continue
+        thc = math.sqrt(radii[sphere] ** 2 - d2)
+        if tca - thc > 0.001:
+            t = tca - thc
+        elif tca + thc > 0.001:
+            t = tca + thc
+        else:
+            continue
+        if t <= distance:
+            nearest, distance = sphere, t
+
+    if distance >= max_distance:
+        return distance, -2
+    return distance, nearest
+
+
+@njit(parallel=True, **_OPTIONS)
+def whitted_pixels(
+    width,
+    height,
+    rows,
+    cols,
+    fov,
+    centers,
+    radii,
+    material_index,
+    plane_material,
+    albedo,
+    diffuse_color,
+    refractive_index,
+    specular_exponent,
+    lights,
+    background,
+    max_depth,
+    min_contribution,
+    colors,
+):
+    """Colors of the pixels (rows, cols) of 'rt.render_tile', without recursion.
+
+    The color of a ray is its local shading plus its reflection and
+    refraction scaled by the albedo, so every pixel keeps a stack of rays
+    with the weight they are added to the pixel with. Branches of zero
+    weight or below 'min_contribution' are not traced
+    """
+
+    dir_z = -height / (2.0 * math.tan(fov / 2.0))
+    for pixel in prange(len(rows)):
+        i, j = rows[pixel], cols[pixel]
+        dx, dy, dz = (j + 0.5) - width / 2, -(i + 0.5) + height / 2, dir_z
+        norm = 1.0 / math.sqrt(dx * dx + dy * dy + dz * dz)
+
+        # origin, direction, weight, depth of the queued rays. Every ray
+        # replaces itself by at most two one bounce deeper and rays deeper than
+        # 'max_depth' spawn none, so the stack never holds more than
+        # max_depth + 2 of them
+        rays = np.empty((max_depth + 2, 8))
+        _push(rays, 0, 0.0, 0.0, 0.0, dx * norm, dy * norm, dz * norm, 1.0, 0)
+        queued = 1
+        red = green = blue = 0.0
+        while queued:
+            queued -= 1
+            ox, oy, oz = rays[queued, 0], rays[queued, 1], rays[queued, 2]
+            dx, dy, dz = rays[queued, 3], rays[queued, 4], rays[queued, 5]
+            weight, depth = rays[queued, 6], rays[queued, 7]
+
+            distance, sphere = _whitted_hit(
+                ox, oy, oz, dx, dy, dz, centers, radii, 1000
+            )
+            if depth > max_depth or sphere == -2:
+                red += weight * background[0]
+                green += weight * background[1]
+                blue += weight * background[2]
+                continue
+
+            px, py, pz = ox + dx * distance, oy + dy * distance, oz + dz * distance
+            if sphere == -1:
+                material = plane_material
+                nx, ny, nz = 0.0, 1.0, 0.0
+                if (int(0.5 * px + 1000) + int(0.5 * pz)) & 1:
+                    cr, cg, cb = 0.3, 0.3, 0.3
+                else:
+                    cr, cg, cb = 0.3, 0.2, 0.1
+            else:
+                material = material_index[sphere]
+                nx = px - centers[sphere, 0]
+                ny = py - centers[sphere, 1]
+                nz = pz - centers[sphere, 2]
+                norm = 1.0 / math.sqrt(nx * nx + ny * ny + nz * nz)
+                nx, ny, nz = nx * norm, ny * norm, nz * norm
+                cr = diffuse_color[material, 0]
+                cg = diffuse_color[material, 1]
+                cb = diffuse_color[material, 2]
+
+            cos_i = dx * nx + dy * ny + dz * nz
+            reflect_weight = weight * albedo[material, 2]
+            if reflect_weight > 0 and reflect_weight >= min_contribution:
+                rx = dx - nx * 2.0 * cos_i
+                ry = dy - ny * 2.0 * cos_i
+                rz = dz - nz * 2.0 * cos_i
+                norm = 1.0 / math.sqrt(rx * rx + ry * ry + rz * rz)
+                _push(
+                    rays,
+                    queued,
+                    px,
+                    py,
+                    pz,
+                    rx * norm,
+                    ry * norm,
+                    rz * norm,
+                    reflect_weight,
+                    depth + 1,
+                )
+                queued += 1
+
+            refract_weight = weight * albedo[material, 3]
+            if refract_weight > 0 and refract_weight >= min_contribution:
+                # 'rt.refract': flip the normal for rays leaving the object
+                cosi = -max(-1.0, min(1.0, cos_i))
+                fx, fy, fz = nx, ny, nz
+                eta = 1.0 / refractive_index[material]
+                if cosi < 0:
+                    cosi, fx, fy, fz = -cosi, -nx, -ny, -nz
+                    eta = refractive_index[material]
+                k = 1 - eta * eta * (1 - cosi * cosi)
+                if k < 0:
+                    rx, ry, rz = 1.0, 0.0, 0.0
+                else:
+                    along = eta * cosi - math.sqrt(k)
+                    rx = dx * eta + fx * along
+                    ry = dy * eta + fy * along
+                    rz = dz * eta + fz * along
+                norm = 1.0 / math.sqrt(rx * rx + ry * ry + rz * rz)
+                _push(
+                    rays,
+                    queued,
+                    px,
+                    py,
+                    pz,
+                    rx * norm,
+                    ry * norm,
+                    rz * norm,
+                    refract_weight,
+                    depth + 1,
+                )
+                queued += 1
+
+            diffuse_intensity = specular_intensity = 0.0
+            for light in range(len(lights)):
+                lx, ly, lz = (
+                    lights[light, 0] - px,
+                    lights[light, 1] - py,
+                    lights[light, 2] - pz,
+                )
+                light_distance = math.sqrt(lx * lx + ly * ly + lz * lz)
+                norm = 1.0 / light_distance
+                lx, ly, lz = lx * norm, ly * norm, lz * norm
+                # hits further than 1000 are misses, as in 'rt.scene_occluded'
+                _, blocker = _whitted_hit(
+                    px, py, pz, lx, ly, lz, centers, radii, min(light_distance, 1000)
+                )
+                if blocker != -2:
+                    continue
+
+                cos_l = lx * nx + ly * ny + lz * nz
+                diffuse_intensity += max(0.0, cos_l)
+                # -reflect(-light_dir, N) * dir
+                mirror = (
+                    (lx - nx * 2.0 * cos_l) * dx
+                    + (ly - ny * 2.0 * cos_l) * dy
+                    + (lz - nz * 2.0 * cos_l) * dz
+                )
+                specular_intensity += max(0.0, mirror) ** specular_exponent[material]
+
+            diffuse_intensity *= albedo[material, 0]
+            specular_intensity *= albedo[material, 1]
+            red += weight * (cr * diffuse_intensity + specular_intensity)
+            green += weight * (cg * diffuse_intensity + specular_intensity)
+            blue += weight * (cb * diffuse_intensity + specular_intensity)
+
+        colors[pixel, 0] = red
+        colors[pixel, 1] = green
+        colors[pixel, 2] = blue
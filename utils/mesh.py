@@ -0,0 +1,378 @@
+import re
+
+import numpy as np
+
+from utils.scene import MAX_PAIRS_PER_CHUNK, OCCLUSION_BLOCK
+
+# Bytes of an OBJ file parsed at once, memory used while loading is bounded
+# by a few times this plus the vertex and index buffers
+OBJ_CHUNK_SIZE = 1 << 20
+
+# The Moller-Trumbore test keeps several (rays, triangles, 3) temporaries
+PAIRS_PER_CHUNK = MAX_PAIRS_PER_CHUNK // 4
+
+DEFAULT_MATERIAL = {
+    "ambient": np.array([0.1, 0.1, 0.1]),
+    "diffuse": np.array([0.6, 0.6, 0.6]),
+    "specular": np.array([1, 1, 1]),
+    "shininess": 100,
+    "reflection": 0.2,
+}
+
+
+def _line_blocks(file, chunk_size):
+    """Lists of the complete lines in consecutive chunks of a binary file.
+
+    Tabs become spaces and "#" comments are removed
+    """
+
+    rest = b""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        end = chunk.rfind(b"\n") + 1
+        rest = chunk[end:]
+        yield _clean(chunk[:end]).split(b"\n")
+    if rest:
+        yield _clean(rest).split(b"\n")
+
+
+def _clean(text):
+    text = text.replace(b"\t", b" ")
+    if b"#" in text:
+        text = re.sub(rb"#[^\n]*", b"", text)
+    return text
+
+
+def _read_numbers(text, dtype, error):
+    """Numbers of a whitespace separated text, ValueError('error') if it has others"""
+
+    try:
+        return np.fromstring(text, dtype=dtype, sep=" ")
+    except ValueError:
+        raise ValueError(error) from None
+
+
+def _parse_vertices(lines):
+    text = b"\n".join(lines)
+    try:
+        values = np.fromstring(text, dtype=np.float32, sep=" ")
+    except ValueError:
+        values = None
+    if values is None or len(values) != 3 * len(lines):
+        # "v x y z w" or vertex colors: keep the position only
+        values = _read_numbers(
+            b" ".join(b" ".join(line.split()[:3]) for line in lines),
+            np.float32,
+            "Malformed vertex in OBJ file",
+        )
+        if len(values) != 3 * len(lines):
+            raise ValueError("Malformed vertex in OBJ file")
+    return values.reshape(-1, 3)
+
+
+def _parse_faces(lines):
+    """Triangles of face lines as (T, 3) OBJ indices and the face of each.
+
+    Only the vertex index of a corner is kept and polygons are triangulated
+    as fans around their first corner
+    """
+
+    text = b"\n".join(lines)
+    if b"/" in text:
+        # "v/vt/vn", "v//vn" and "v/vt": only the vertex index is used
+        text = re.sub(rb"/\S*", b"", text)
+    corners = _read_numbers(text, np.int64, "Malformed face in OBJ file")
+
+    if len(corners) == 3 * len(lines):
+        return corners.reshape(-1, 3), np.arange(len(lines))
+
+    counts = np.array([len(line.split()) for line in lines])
+    if len(corners) != counts.sum() or counts.min() < 3:
+        raise ValueError("Malformed face in OBJ file")
+    face = np.repeat(np.arange(len(lines)), counts - 2)
+    first = (np.cumsum(counts) - counts)[face]
+    fan_start = np.cumsum(counts - 2) - (counts - 2)
+    k = np.arange(len(face)) - fan_start[face] + 1
+    triangles = np.stack(
+        (corners[first], corners[first + k], corners[first + k + 1]), axis=1
+    )
+    return triangles, face
+
+
+def load_obj(path, chunk_size=OBJ_CHUNK_SIZE):
+    """Vertices (V, 3) float32 and triangles (T, 3) int32 of a Wavefront OBJ file.
+
+    The file is parsed in chunks of 'chunk_size' bytes, every chunk with a
+    few array operations, no Python object is made per face or vertex that
+    outlives its chunk. Only "v" and "f" lines are read: texture coordinates,
+    normals, groups and materials are ignored, polygons are triangulated as
+    fans and relative (negative) indices are resolved
+    """
+
+    vertex_blocks, triangle_blocks = [], []
+    vertex_count = 0
+    with open(path, "rb") as file:
+        for lines in _line_blocks(file, chunk_size):
+            vertex_lines = [line[2:] for line in lines if line[:2] == b"v "]
+            face_lines = [line[2:] for line in lines if line[:2] == b"f "]
+
+            if face_lines:
+                triangles, face = _parse_faces(face_lines)
+                if triangles.min() < 0:
+                    # relative indices count back from the last vertex so far
+                    bases, count = [], vertex_count
+                    for line in lines:
+                        if line[:2] == b"v ":
+                            count += 1
+                        elif line[:2] == b"f ":
+                            bases.append(count)
+                    base = np.array(bases)[face, np.newaxis]
+                    triangles = np.where(triangles < 0, triangles + base + 1, triangles)
+                # OBJ indices start at 1
+                triangle_blocks.append(triangles - 1)
+            if vertex_lines:
+                vertex_blocks.append(_parse_vertices(vertex_lines))
+                vertex_count += len(vertex_lines)
+
+    vertices = np.concatenate(vertex_blocks or [np.zeros((0, 3), np.float32)])
+    triangles = np.concatenate(triangle_blocks or [np.zeros((0, 3), np.int64)])
+    if len(triangles) and (triangles.min() < 0 or triangles.max() >= len(vertices)):
+        raise ValueError(f"{path} has faces referring to missing vertices")
+    return vertices, triangles.astype(np.int32)
+
+
+def _cross(a, b):
+    return np.stack(
+        (
+            a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+            a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+            a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0],
+        ),
+        axis=-1,
+    )
+
+
+class TriangleMesh:
+    """Triangles in packed vertex and index buffers, a drop-in for 'Scene'.
+
+    Vertices are float32 (V, 3) and triangles int32 (T, 3) rows of vertex
+    indices. A closed mesh has about half as many vertices as triangles, so
+    a triangle costs about 22 bytes: 12 of indices, 6 of vertices and 4 of
+    material index. Intersections are computed in 'dtype' with the
+    Moller-Trumbore test, shading uses flat face normals. Every triangle is
+    an index into the material table as in 'Scene'
+    """
+
+    def __init__(
+        self,
+        vertices,
+        triangles,
+        material_index=0,
+        ambient=DEFAULT_MATERIAL["ambient"],
+        diffuse=DEFAULT_MATERIAL["diffuse"],
+        specular=DEFAULT_MATERIAL["specular"],
+        shininess=DEFAULT_MATERIAL["shininess"],
+        reflection=DEFAULT_MATERIAL["reflection"],
+        dtype=np.float64,
+    ):
+        self.dtype = np.dtype(dtype)
+
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float32).reshape(-1, 3)
+        self.triangles = np.ascontiguousarray(triangles, dtype=np.int32).reshape(-1, 3)
+        self.material_index = np.ascontiguousarray(
+            np.broadcast_to(material_index, len(self.triangles)), dtype=np.int32
+        )
+
+        self.ambient = np.ascontiguousarray(ambient, dtype=self.dtype).reshape(-1, 3)
+        self.diffuse = np.ascontiguousarray(diffuse, dtype=self.dtype).reshape(-1, 3)
+        self.specular = np.ascontiguousarray(specular, dtype=self.dtype).reshape(-1, 3)
+        self.shininess = np.ascontiguousarray(shininess, dtype=self.dtype).reshape(-1)
+        self.reflection = np.ascontiguousarray(reflection, dtype=self.dtype).reshape(-1)
+
+        self.bvh = None
+
+    @classmethod
+    def from_obj(cls, path, dtype=np.float64, **material):
+        """Mesh of an OBJ file with a single material, DEFAULT_MATERIAL by default"""
+
+        vertices, triangles = load_obj(path)
+        return cls(vertices, triangles, dtype=dtype, **material)
+
+    def fitted(self, size=1.0, center=(0, 0, -1), floor=None):
+        """Copy scaled to 'size' across and centered at 'center'.
+
+        With a 'floor' height it is moved up or down to stand on it instead
+        """
+
+        lo, hi = self.vertices.min(axis=0), self.vertices.max(axis=0)
+        scale = size / max((hi - lo).max(), 1e-30)
+        vertices = (self.vertices - (lo + hi) / 2) * scale + np.asarray(center)
+        if floor is not None:
+            vertices[:, 1] += floor - vertices[:, 1].min()
+        return TriangleMesh(
+            vertices,
+            self.triangles,
+            self.material_index,
+            self.ambient,
+            self.diffuse,
+            self.specular,
+            self.shininess,
+            self.reflection,
+            self.dtype,
+        )
+
+    def __len__(self):
+        return len(self.triangles)
+
+    @property
+    def nbytes(self):
+        """Memory used by the vertex, index and material arrays"""
+
+        return sum(
+            array.nbytes
+            for array in (
+                self.vertices,
+                self.triangles,
+                self.material_index,
+                self.ambient,
+                self.diffuse,
+                self.specular,
+                self.shininess,
+                self.reflection,
+            )
+        )
+
+    def content(self):
+        """Arrays that determine how the mesh renders, for cache keys"""
+
+        return (
+            self.vertices,
+            self.triangles,
+            self.material_index,
+            self.ambient,
+            self.diffuse,
+            self.specular,
+            self.shininess,
+            self.reflection,
+        )
+
+    def build_bvh(self, leaf_size=16, bins=16):
+        """Build a bounding volume hierarchy that 'intersect' uses from now on"""
+
+        from utils.bvh import BVH
+
+        corners = self.vertices[self.triangles]
+        self.bvh = BVH(
+            corners.min(axis=1), corners.max(axis=1), leaf_size, bins, self.dtype
+        )
+        return self.bvh
+
+    def intersect(self, ray_origins, ray_directions, cost=None):
+        """Nearest triangle for every ray, see 'Scene.intersect'"""
+
+        if self.bvh is not None:
+            return self.bvh.intersect(
+                ray_origins, ray_directions, self._triangle_distances, cost
+            )
+
+        if cost is not None:
+            cost += len(self)
+
+        count = len(ray_origins)
+        nearest = np.full(count, -1)
+        min_distance = np.full(count, np.inf, dtype=self.dtype)
+        if count == 0 or len(self) == 0:
+            return nearest, min_distance
+
+        chunk = max(1, PAIRS_PER_CHUNK // len(self))
+        for start in range(0, count, chunk):
+            stop = min(start + chunk, count)
+            distances = self._triangle_distances(
+                ray_origins[start:stop], ray_directions[start:stop]
+            )
+            index = np.argmin(distances, axis=1)
+            distance = distances[np.arange(len(index)), index]
+            nearest[start:stop] = np.where(np.isfinite(distance), index, -1)
+            min_distance[start:stop] = distance
+        return nearest, min_distance
+
+    def occluded(self, ray_origins, ray_directions, max_distance, cost=None):
+        """Whether every ray hits any triangle in (0, max_distance), see 'Scene.occluded'"""
+
+        count = len(ray_origins)
+        max_distance = np.broadcast_to(max_distance, (count,))
+        if self.bvh is not None:
+            return self.bvh.occluded(
+                ray_origins,
+                ray_directions,
+                self._triangle_distances,
+                max_distance,
+                cost,
+            )
+
+        blocked = np.zeros(count, dtype=bool)
+        if count == 0 or len(self) == 0:
+            return blocked
+
+        block = min(len(self), OCCLUSION_BLOCK)
+        chunk = max(1, PAIRS_PER_CHUNK // block)
+        for start in range(0, count, chunk):
+            stop = min(start + chunk, count)
+            rays = np.arange(start, stop)
+            origins, directions = ray_origins[start:stop], ray_directions[start:stop]
+            limit = max_distance[start:stop, np.newaxis]
+            for first in range(0, len(self), block):
+                triangles = np.arange(first, min(first + block, len(self)))
+                if cost is not None:
+                    cost[rays] += len(triangles)
+
+                distances = self._triangle_distances(origins, directions, triangles)
+                hit = (distances < limit).any(axis=1)
+                blocked[rays[hit]] = True
+                if triangles[-1] == len(self) - 1 or hit.all():
+                    break
+                if hit.any():
+                    rays, limit = rays[~hit], limit[~hit]
+                    origins, directions = origins[~hit], directions[~hit]
+        return blocked
+
+    def normals(self, index, points, directions):
+        """Unit face normals of the triangles 'index', facing against 'directions'"""
+
+        v0, v1, v2 = (
+            self.vertices[self.triangles[index]].astype(self.dtype).swapaxes(0, 1)
+        )
+        normal = _cross(v1 - v0, v2 - v0)
+        normal /= np.linalg.norm(normal, axis=-1, keepdims=True)
+        facing = np.einsum("ij,ij->i", normal, directions) > 0
+        normal[facing] *= -1
+        return normal
+
+    def object_ids(self, index):
+        """Material of the triangles 'index', -1 for none, for edge detection"""
+
+        return np.where(index >= 0, self.material_index[index], -1)
+
+    def _triangle_distances(self, ray_origins, ray_directions, triangles=slice(None)):
+        """(rays, triangles) Moller-Trumbore hit distances, inf for misses"""
+
+        v0, v1, v2 = (
+            self.vertices[self.triangles[triangles]].astype(self.dtype).swapaxes(0, 1)
+        )
+        edge1, edge2 = v1 - v0, v2 - v0
+
+        directions = ray_directions[:, np.newaxis, :]
+        p = _cross(directions, edge2)
+        determinant = np.einsum("rtk,tk->rt", p, edge1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inverse = 1 / determinant
+            s = ray_origins[:, np.newaxis, :] - v0
+            u = np.einsum("rtk,rtk->rt", s, p) * inverse
+            q = _cross(s, edge1)
+            v = (directions * q).sum(axis=-1) * inverse
+            t = np.einsum("rtk,tk->rt", q, edge2) * inverse
+        hit = (determinant != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0)
+        return np.where(hit, t, np.inf)
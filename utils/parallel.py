@@ -0,0 +1,125 @@
+import os
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+from utils import jit
+
+DEFAULT_TILE_SIZE = 32
+
+# Set in every worker process by '_init_worker'
+_worker = {}
+
+
+def tiles(width, height, tile_size=DEFAULT_TILE_SIZE):
+    """Split a width x height frame into (top, left, bottom, right) tiles"""
+
+    return [
+        (top, left, min(top + tile_size, height), min(left + tile_size, width))
+        for top in range(0, height, tile_size)
+        for left in range(0, width, tile_size)
+    ]
+
+
+def _init_worker(name, shape, render_tile, args, kwargs):
+    # the frame is already split between processes
+    jit.set_threads(1)
+    if name is not None:
+        memory = shared_memory.SharedMemory(name=name)
+        _worker["memory"] = memory
+        _worker["framebuffer"] = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+    _worker["size"] = shape[1], shape[0]
+    _worker["render_tile"] = render_tile
+    _worker["args"] = args
+    _worker["kwargs"] = kwargs
+
+
+def _render_tile_to_parent(tile):
+    top, left, bottom, right = tile
+    width, height = _worker["size"]
+    render_tile, args = _worker["render_tile"], _worker["args"]
+    return (
+        top,
+        left,
+        render_tile(
+            width, height, top, left, bottom, right, *args, **_worker["kwargs"]
+        ),
+    )
+
+
+def _render_tile(tile):
+    top, left, bottom, right = tile
+    framebuffer = _worker["framebuffer"]
+    height, width = framebuffer.shape[:2]
+    framebuffer[top:bottom, left:right] = _worker["render_tile"](
+        width, height, top, left, bottom, right, *_worker["args"], **_worker["kwargs"]
+    )
+    return tile
+
+
+def render_parallel(
+    render_tile,
+    width,
+    height,
+    args=(),
+    workers=None,
+    tile_size=DEFAULT_TILE_SIZE,
+    progress=None,
+    writer=None,
+    kwargs=None,
+):
+    """Render a frame with a pool of processes writing into a shared framebuffer.
+
+    'render_tile(width, height, top, left, bottom, right, *args, **kwargs)'
+    must be a module level function returning a (bottom - top, right - left, 3)
+    array.
+    Tiles are handed out one at a time, so a worker that got cheap sky tiles
+    simply takes more of them. 'progress(done, total)' is called in the
+    parent process after every finished tile.
+
+    With an ImageWriter 'writer' the tiles are sent back to the parent and
+    written as they finish instead, no frame is allocated and None is returned
+    """
+
+    workers = workers or os.cpu_count()
+    shape = (height, width, 3)
+    jobs = tiles(width, height, tile_size)
+
+    if writer is not None:
+        with Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(None, shape, render_tile, args, kwargs or {}),
+        ) as pool:
+            for done, (top, left, tile) in enumerate(
+                pool.imap_unordered(_render_tile_to_parent, jobs, chunksize=1), 1
+            ):
+                writer.write(top, left, tile)
+                if progress:
+                    progress(done, len(jobs))
+        return None
+
+    memory = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize
+    )
+    try:
+        framebuffer = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+        framebuffer[:] = 0
+
+        with Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(memory.name, shape, render_tile, args, kwargs or {}),
+        ) as pool:
+            for done, _ in enumerate(
+                pool.imap_unordered(_render_tile, jobs, chunksize=1), 1
+            ):
+                if progress:
+                    progress(done, len(jobs))
+
+        image = framebuffer.copy()
+        del framebuffer
+    finally:
+        memory.close()
+        memory.unlink()
+
+    return image
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Pixel strides of the preview levels, coarse to fine. Every stride must
+# divide the previous one, so that a level only traces the pixels between
+# the ones of the coarser levels
+PREVIEW_SCALES = (8, 4, 2, 1)
+# Pixels traced per call of 'render_samples', a preview can be cancelled
+# between two batches
+BATCH_SIZE = 1 << 14
+
+
+def level_pixels(width, height, scale, coarser=None):
+    """Rows and columns of the pixels every 'scale' pixels apart.
+
+    Pixels already on the grid of the 'coarser' level are left out
+    """
+
+    rows, cols = np.mgrid[0:height:scale, 0:width:scale]
+    rows, cols = rows.ravel(), cols.ravel()
+    if coarser is not None:
+        new = (rows % coarser != 0) | (cols % coarser != 0)
+        rows, cols = rows[new], cols[new]
+    return rows, cols
+
+
+def upscaled(frame, scale):
+    """Nearest neighbour upscale of the pixels of 'frame' every 'scale' pixels apart"""
+
+    if scale == 1:
+        return frame
+    height, width = frame.shape[:2]
+    coarse = frame[::scale, ::scale]
+    return np.repeat(np.repeat(coarse, scale, axis=0), scale, axis=1)[:height, :width]
+
+
+def render_levels(
+    render_samples, width, height, scales=PREVIEW_SCALES, batch_size=BATCH_SIZE
+):
+    """Render a width x height frame coarse to fine.
+
+    'render_samples(width, height, rows, cols)' must return the (N, 3)
+    colors of the pixels at (rows, cols). The level of every scale traces
+    the pixels every 'scale' rows and columns apart that no coarser level
+    traced, so the full resolution level costs no more than a plain frame.
+    Yields (scale, frame, done) after every batch: 'frame' holds all pixels
+    traced so far and 'done' tells whether the level is complete
+    """
+
+    frame = np.zeros((height, width, 3))
+    coarser = None
+    for scale in scales:
+        rows, cols = level_pixels(width, height, scale, coarser)
+        if not len(rows):
+            yield scale, frame, True
+        for start in range(0, len(rows), batch_size):
+            batch = slice(start, start + batch_size)
+            frame[rows[batch], cols[batch]] = render_samples(
+                width, height, rows[batch], cols[batch]
+            )
+            yield scale, frame, batch.stop >= len(rows)
+        coarser = scale
@@ -0,0 +1,54 @@
+import numpy as np
+
+# Secondary rays whose throughput (the factor their color is multiplied with
+# in the pixel) is below this are cut off or played Russian roulette with
+MIN_CONTRIBUTION = 0.05
+
+
+class RayPruning:
+    """Termination of secondary rays that contribute little to their pixel.
+
+    Rays with zero throughput are always skipped by the tracers, that never
+    changes the image. Below 'min_contribution' a ray is dropped, which
+    darkens the image slightly, or with 'roulette' it survives with
+    probability throughput / min_contribution and its throughput is raised
+    to min_contribution, which keeps the expected pixel value unchanged
+    """
+
+    def __init__(self, min_contribution=MIN_CONTRIBUTION, roulette=False, seed=0):
+        self.min_contribution = min_contribution
+        self.roulette = roulette
+        self.seed = seed
+
+    def content(self):
+        return self.min_contribution, self.roulette, self.seed
+
+    def generator(self, top, left):
+        """Random numbers for the tile at (top, left), reproducible in any tile order"""
+
+        return np.random.default_rng((self.seed, top, left))
+
+    def survive(self, throughput, rng):
+        """Factor to scale a ray by, 0 if the ray is terminated"""
+
+        if throughput >= self.min_contribution:
+            return 1.0
+        if not self.roulette or throughput <= 0:
+            return 0.0
+        probability = throughput / self.min_contribution
+        return 1 / probability if rng.random() < probability else 0.0
+
+    def survivors(self, throughput, rng):
+        """Vectorized 'survive': a mask of the surviving rays and their factors"""
+
+        low = throughput < self.min_contribution
+        scale = np.ones(len(throughput), dtype=throughput.dtype)
+        if not self.roulette:
+            return ~low & (throughput > 0), scale
+
+        probability = throughput[low] / self.min_contribution
+        alive = rng.random(len(probability)) < probability
+        keep = ~low & (throughput > 0)
+        keep[np.flatnonzero(low)[alive]] = True
+        scale[low] = np.where(alive, 1 / np.maximum(probability, 1e-30), 0)
+        return keep, scale
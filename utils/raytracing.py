@@ -1,6 +1,10 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
+from utils import jit
+from utils.cache import content_hash
+from utils.imageio import open_image, save_image
+from utils.parallel import DEFAULT_TILE_SIZE, render_parallel, tiles
+from utils.scene import Scene
+from utils.stats import timed
 
 
 def normalize(vector):
@@ -37,6 +41,26 @@ def nearest_intersected_object(objects, ray_origin, ray_direction):
     return nearest_object, min_distance
 
 
+def any_intersected_object(objects, ray_origin, ray_direction, max_distance):
+    """Whether the ray hits any object closer than 'max_distance', for shadows"""
+
+    for obj in objects:
+        distance = sphere_intersect(
+            obj["center"], obj["radius"], ray_origin, ray_direction
+        )
+        if distance and distance < max_distance:
+            return True
+    return False
+
+
+def normalize_rows(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def reflected_rows(vectors, axes):
+    return vectors - 2 * np.sum(vectors * axes, axis=-1, keepdims=True) * axes
+
+
 light = {
     "position": np.array([5, 5, 5]),
     "ambient": np.array([1, 1, 1]),
@@ -84,13 +108,530 @@ objects = [
 ]
 
 
-def render_image(w, h):
-    width = w
-    height = h
+camera = np.array([0, 0, 1])
+
+# Bump when a change alters the rendered pixels, it invalidates cached frames
+ENGINE_VERSION = 2
+# 'render_tile' runs the kernels of utils.kernels when utils.jit enables them
+JIT_KERNELS = True
+
+# Offset of secondary ray origins along the normal against self-intersection,
+# it must exceed the rounding error of hit points. With the stable quadratic
+# roots of 'Scene' that error is ~1e-6 in float32 for this scene (acne starts
+# below 3e-6), while a larger offset lights up more pixels just behind the
+# shadow terminator, so both precisions keep the original 1e-5
+SHIFT_EPSILON = {np.dtype(np.float64): 1e-5, np.dtype(np.float32): 1e-5}
+
+
+def primary_rays(
+    width, height, top=0, left=0, bottom=None, right=None, dtype=np.float64
+):
+    """Rays from the camera through pixels [top:bottom, left:right] as (N, 3) arrays"""
+
+    bottom = height if bottom is None else bottom
+    right = width if right is None else right
+    if jit.enabled():
+        from utils import kernels
+
+        count = (bottom - top) * (right - left)
+        origins = np.empty((count, 3), dtype=dtype)
+        directions = np.empty((count, 3), dtype=dtype)
+        with jit.KERNEL_LOCK:
+            kernels.primary_rays(
+                width,
+                height,
+                top,
+                left,
+                bottom,
+                right,
+                camera.astype(dtype),
+                origins,
+                directions,
+            )
+        return origins, directions
+
+    ratio = float(width) / height
+    screen = (-1, 1 / ratio, 1, -1 / ratio)  # left, top, right, bottom
+
+    xs = np.linspace(screen[0], screen[2], width)[left:right]
+    ys = np.linspace(screen[1], screen[3], height)[top:bottom]
+    pixels = np.zeros((len(ys), len(xs), 3), dtype=dtype)
+    pixels[:, :, 0] = xs[np.newaxis, :]
+    pixels[:, :, 1] = ys[:, np.newaxis]
+
+    directions = normalize_rows(pixels.reshape(-1, 3) - camera.astype(dtype))
+    origins = np.tile(camera.astype(dtype), (len(directions), 1))
+    return origins, directions
+
+
+def sample_rays(width, height, rows, cols, dtype=np.float64):
+    """Rays through fractional pixel coordinates, 'primary_rays' at integer ones"""
 
-    max_depth = 3
+    ratio = float(width) / height
+    screen = (-1, 1 / ratio, 1, -1 / ratio)  # left, top, right, bottom
+
+    # same arithmetic as np.linspace
+    x_step = (screen[2] - screen[0]) / max(width - 1, 1)
+    y_step = (screen[3] - screen[1]) / max(height - 1, 1)
+    pixels = np.zeros((len(rows), 3), dtype=dtype)
+    pixels[:, 0] = cols * x_step + screen[0]
+    pixels[:, 1] = rows * y_step + screen[1]
+
+    directions = normalize_rows(pixels - camera.astype(dtype))
+    origins = np.tile(camera.astype(dtype), (len(directions), 1))
+    return origins, directions
+
+
+def trace_rays(
+    origins,
+    directions,
+    max_depth=3,
+    scene=None,
+    stats=None,
+    cost=None,
+    hit_ids=None,
+    pruning=None,
+    rng=None,
+):
+    """Trace a batch of rays, every bounce is computed for all active rays at once.
+
+    The scene is a 'Scene' of spheres, a 'TriangleMesh' or a 'SceneGroup'
+    of them. Everything is computed in the dtype of the scene (float64 or
+    float32), rays are expected in the same dtype. With a RenderStats
+    'stats' rays, tests and stage times are counted and the intersection
+    tests of every ray are added to the 'cost' array if given. The object
+    every ray hits first (-1 for none) is written to 'hit_ids' if given.
+    Rays whose accumulated reflection dropped to zero stop bouncing, with a
+    RayPruning 'pruning' so do rays below its contribution threshold ('rng'
+    draws the Russian roulette). When utils.jit enables the compiled
+    kernels, rays in a 'Scene' without BVH are traced by
+    'kernels.trace_spheres' unless 'stats' or the roulette need the NumPy
+    code
+    """
+
+    if scene is None:
+        scene = Scene.from_objects(objects)
+    if (
+        jit.enabled()
+        and stats is None
+        and type(scene) is Scene
+        and scene.bvh is None
+        and (pruning is None or not pruning.roulette)
+    ):
+        return _trace_rays_jit(origins, directions, max_depth, scene, hit_ids, pruning)
+
+    if stats is not None and cost is None:
+        # the tests of every ray are counted anyway, keep them in a scratch array
+        cost = np.zeros(len(origins), dtype=int)
+
+    dtype = scene.dtype
+    epsilon = SHIFT_EPSILON[dtype]
+    eye = camera.astype(dtype)
+    light_position = light["position"].astype(dtype)
+    ambient = scene.ambient * light["ambient"].astype(dtype)
+    diffuse = scene.diffuse * light["diffuse"].astype(dtype)
+    specular = scene.specular * light["specular"].astype(dtype)
+
+    colors = np.zeros((len(origins), 3), dtype=dtype)
+    # indices of rays that are still bouncing and their accumulated reflection
+    active = np.arange(len(origins))
+    reflection = np.ones(len(origins), dtype=dtype)
+
+    for k in range(max_depth):
+
+        # проверка пересечений
+
+        with timed(stats, "intersect"):
+            ray_cost = None if stats is None else np.zeros(len(active), dtype=int)
+            nearest, min_distance = scene.intersect(origins, directions, ray_cost)
+        hit = nearest >= 0
+        if stats is not None:
+            kind = "reflection" if k else "primary"
+            stats.count(kind, len(active), np.count_nonzero(hit), ray_cost.sum(), k)
+            cost[active] += ray_cost
+        if k == 0 and hit_ids is not None:
+            hit_ids[:] = scene.object_ids(nearest)
+
+        active, origins, directions = active[hit], origins[hit], directions[hit]
+        nearest, min_distance = nearest[hit], min_distance[hit]
+        reflection = reflection[hit]
+        if len(active) == 0:
+            break
+
+        intersection = origins + min_distance[:, np.newaxis] * directions
+        material = scene.material_index[nearest]
+        normal_to_surface = scene.normals(nearest, intersection, directions)
+        shifted_point = intersection + epsilon * normal_to_surface
+        intersection_to_light = normalize_rows(light_position - shifted_point)
+
+        with timed(stats, "shadow"):
+            ray_cost = None if stats is None else np.zeros(len(active), dtype=int)
+            intersection_to_light_distance = np.linalg.norm(
+                light_position - intersection, axis=1
+            )
+            lit = ~scene.occluded(
+                shifted_point,
+                intersection_to_light,
+                intersection_to_light_distance,
+                ray_cost,
+            )
+        if stats is not None:
+            blocked = len(active) - np.count_nonzero(lit)
+            stats.count("shadow", len(active), blocked, ray_cost.sum())
+            cost[active] += ray_cost
+
+        active, material, reflection = active[lit], material[lit], reflection[lit]
+        directions, intersection = directions[lit], intersection[lit]
+        normal_to_surface, shifted_point = normal_to_surface[lit], shifted_point[lit]
+        intersection_to_light = intersection_to_light[lit]
+        if len(active) == 0:
+            break
+
+        illumination = _illumination(
+            material,
+            normal_to_surface,
+            intersection_to_light,
+            normalize_rows(eye - intersection),
+            ambient,
+            diffuse,
+            specular,
+            scene.shininess,
+        )
+
+        # reflection
+
+        colors[active] += reflection[:, np.newaxis] * illumination
+        reflection = reflection * scene.reflection[material]
+        origins = shifted_point
+        directions = reflected_rows(directions, normal_to_surface)
+
+        # rays that can't change their pixel any more are not traced further
+        if pruning is None:
+            bouncing = reflection > 0
+        else:
+            bouncing, scale = pruning.survivors(reflection, rng)
+            reflection *= scale
+        active, reflection = active[bouncing], reflection[bouncing]
+        origins, directions = origins[bouncing], directions[bouncing]
+
+    return np.clip(colors, 0, 1)
+
+
+def _illumination(
+    material, normal, to_light, to_camera, ambient, diffuse, specular, shininess
+):
+    """Blinn-Phong shading of lit hits, the light is part of the material colors"""
+
+    # ambiant
+
+    illumination = ambient[material].copy()
+
+    # diffuse
+
+    illumination += diffuse[material] * np.sum(to_light * normal, axis=1, keepdims=True)
+
+    # specular
+
+    H = normalize_rows(to_light + to_camera)
+    highlight = np.sum(normal * H, axis=1)
+    illumination += (
+        specular[material] * (highlight ** (shininess[material] / 4))[:, np.newaxis]
+    )
+    return illumination
+
+
+class GBuffer:
+    """Everything shading needs of a batch of rays but the light and materials.
+
+    For every bounce it keeps, of the rays that get there, the index of the
+    ray ('rays'), the hit 'points', 'normals', primitives ('nearest') and
+    'distances', and for shading the 'shifted' shadow ray origins and the
+    directions 'to_camera'. Paths are followed for all bounces whatever the
+    materials reflect, so re-shading after a material edit never needs a
+    new hit. The shadow rays traced for the last light position are kept
+    as well
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.rays = []
+        self.points = []
+        self.normals = []
+        self.nearest = []
+        self.distances = []
+        self.shifted = []
+        self.to_camera = []
+        # shadow rays of the last light position, per bounce
+        self._light_position = None
+        self._traced = self._lit = self._to_light = None
+
+    def add(self, rays, points, normals, nearest, distances, shifted, to_camera):
+        self.rays.append(rays)
+        self.points.append(points)
+        self.normals.append(normals)
+        self.nearest.append(nearest)
+        self.distances.append(distances)
+        self.shifted.append(shifted)
+        self.to_camera.append(to_camera)
+
+    @property
+    def nbytes(self):
+        return sum(
+            array.nbytes
+            for arrays in (
+                self.rays,
+                self.points,
+                self.normals,
+                self.nearest,
+                self.distances,
+                self.shifted,
+                self.to_camera,
+            )
+            for array in arrays
+        )
+
+    def shadows(self, scene, light_position, bounce, hits):
+        """Whether the 'hits' (a mask) of a bounce see the light, and the direction to it.
+
+        Shadow rays are traced in 'scene' only for hits that have none for
+        this light position yet, the results are kept until the light moves
+        """
+
+        if self._light_position is None or not np.array_equal(
+            self._light_position, light_position
+        ):
+            self._light_position = light_position.copy()
+            self._traced = [np.zeros(len(rays), dtype=bool) for rays in self.rays]
+            self._lit = [np.zeros(len(rays), dtype=bool) for rays in self.rays]
+            self._to_light = [np.empty_like(points) for points in self.points]
+
+        missing = hits & ~self._traced[bounce]
+        if missing.any():
+            shifted = self.shifted[bounce][missing]
+            to_light = normalize_rows(light_position - shifted)
+            distances = np.linalg.norm(
+                light_position - self.points[bounce][missing], axis=1
+            )
+            self._lit[bounce][missing] = ~scene.occluded(shifted, to_light, distances)
+            self._to_light[bounce][missing] = to_light
+            self._traced[bounce] |= missing
+        return self._lit[bounce][hits], self._to_light[bounce][hits]
+
+    def depth(self):
+        """Distance of every ray to its first hit, inf for misses"""
+
+        depth = np.full(self.count, np.inf)
+        if self.rays:
+            depth[self.rays[0]] = self.distances[0]
+        return depth
+
+
+def trace_gbuffer(origins, directions, max_depth=3, scene=None):
+    """Visibility part of 'trace_rays': the hits of every bounce as a GBuffer"""
+
+    if scene is None:
+        scene = Scene.from_objects(objects)
+
+    epsilon = SHIFT_EPSILON[scene.dtype]
+    eye = camera.astype(scene.dtype)
+    gbuffer = GBuffer(len(origins))
+    rays = np.arange(len(origins))
+    for _ in range(max_depth):
+        nearest, distances = scene.intersect(origins, directions)
+        hit = nearest >= 0
+        rays, origins, directions = rays[hit], origins[hit], directions[hit]
+        nearest, distances = nearest[hit], distances[hit]
+        if len(rays) == 0:
+            break
+
+        points = origins + distances[:, np.newaxis] * directions
+        normals = scene.normals(nearest, points, directions)
+        origins = points + epsilon * normals
+        gbuffer.add(
+            rays,
+            points,
+            normals,
+            nearest,
+            distances,
+            origins,
+            normalize_rows(eye - points),
+        )
+        directions = reflected_rows(directions, normals)
+    return gbuffer
+
+
+def shade_gbuffer(gbuffer, scene=None, light_source=None, pruning=None, rng=None):
+    """Shading part of 'trace_rays': colors of the rays of a GBuffer.
+
+    'scene' must have the geometry the GBuffer was traced in, its materials
+    and 'light_source' (by default 'light') may have changed. Only shadow
+    rays are traced, for the hits that are shaded and had none traced since
+    the light last moved. Gives the colors of 'trace_rays', with the same
+    'pruning' and 'rng'. A material edit costs only the shading, a moved
+    light also its shadow rays, which are most of the tracing time of a
+    frame in a BVH scene (re-shading is ~2.5x faster than tracing there)
+    """
+
+    if scene is None:
+        scene = Scene.from_objects(objects)
+    light_source = light if light_source is None else light_source
+
+    dtype = scene.dtype
+    light_position = light_source["position"].astype(dtype)
+    ambient = scene.ambient * light_source["ambient"].astype(dtype)
+    diffuse = scene.diffuse * light_source["diffuse"].astype(dtype)
+    specular = scene.specular * light_source["specular"].astype(dtype)
+
+    colors = np.zeros((gbuffer.count, 3), dtype=dtype)
+    # accumulated reflection of every ray, 0 once it stopped bouncing
+    reflection = np.ones(gbuffer.count, dtype=dtype)
+    for bounce, rays in enumerate(gbuffer.rays):
+        bouncing = reflection[rays] > 0
+        lit, intersection_to_light = gbuffer.shadows(
+            scene, light_position, bounce, bouncing
+        )
+        # like in 'trace_rays' rays in shadow stop bouncing
+        reflection[rays[bouncing][~lit]] = 0
+        shaded = np.flatnonzero(bouncing)[lit]
+        rays, intersection_to_light = rays[shaded], intersection_to_light[lit]
+
+        material = scene.material_index[gbuffer.nearest[bounce][shaded]]
+        illumination = _illumination(
+            material,
+            gbuffer.normals[bounce][shaded],
+            intersection_to_light,
+            gbuffer.to_camera[bounce][shaded],
+            ambient,
+            diffuse,
+            specular,
+            scene.shininess,
+        )
+        weight = reflection[rays]
+        colors[rays] += weight[:, np.newaxis] * illumination
+
+        weight *= scene.reflection[material]
+        if pruning is not None:
+            survived, scale = pruning.survivors(weight, rng)
+            weight = np.where(survived, weight * scale, 0)
+        reflection[rays] = weight
+
+    return np.clip(colors, 0, 1)
+
+
+def _trace_rays_jit(origins, directions, max_depth, scene, hit_ids, pruning):
+    """'trace_rays' with 'kernels.trace_spheres', a ray per loop iteration"""
+
+    from utils import kernels
+
+    dtype = scene.dtype
+    colors = np.empty((len(origins), 3), dtype=dtype)
+    if hit_ids is None:
+        hit_ids = np.empty(len(origins), dtype=int)
+    with jit.KERNEL_LOCK:
+        kernels.trace_spheres(
+            np.ascontiguousarray(origins),
+            np.ascontiguousarray(directions),
+            max_depth,
+            scene.centers,
+            scene._center_term,
+            scene.material_index,
+            scene.ambient * light["ambient"].astype(dtype),
+            scene.diffuse * light["diffuse"].astype(dtype),
+            scene.specular * light["specular"].astype(dtype),
+            scene.shininess,
+            scene.reflection,
+            light["position"].astype(dtype),
+            camera.astype(dtype),
+            SHIFT_EPSILON[dtype],
+            0.0 if pruning is None else pruning.min_contribution,
+            colors,
+            hit_ids,
+        )
+    return colors
+
+
+def render_tile(
+    width,
+    height,
+    top,
+    left,
+    bottom,
+    right,
+    max_depth=3,
+    scene=None,
+    stats=None,
+    antialias=None,
+    pruning=None,
+):
+    """Render pixels [top:bottom, left:right] of a width x height frame.
+
+    The precision follows the scene, see 'Scene.from_objects(objects, dtype)'.
+    With an AdaptiveAA 'antialias' edge pixels are supersampled, with a
+    RayPruning 'pruning' low contribution rays are terminated
+    """
+
+    dtype = np.float64 if scene is None else scene.dtype
+    rng = None if pruning is None else pruning.generator(top, left)
+    if antialias is not None:
+
+        def sample(rows, cols):
+            origins, directions = sample_rays(width, height, rows, cols, dtype)
+            cost = None if stats is None else np.zeros(len(origins))
+            ids = np.empty(len(origins), dtype=int)
+            colors = trace_rays(
+                origins, directions, max_depth, scene, stats, cost, ids, pruning, rng
+            )
+            if stats is not None:
+                stats.add_sample_cost(rows, cols, cost)
+            return colors, ids
+
+        return antialias.render(sample, width, height, top, left, bottom, right)
+
+    with timed(stats, "primary rays"):
+        origins, directions = primary_rays(
+            width, height, top, left, bottom, right, dtype
+        )
+
+    cost = None if stats is None else np.zeros(len(origins))
+    colors = trace_rays(
+        origins, directions, max_depth, scene, stats, cost, None, pruning, rng
+    )
+    if stats is not None:
+        stats.add_cost(top, left, cost.reshape(bottom - top, right - left))
+    return colors.reshape(bottom - top, right - left, 3)
+
+
+def render_samples(width, height, rows, cols, max_depth=3, scene=None, pruning=None):
+    """(N, 3) colors of the rays through the (fractional) pixel coordinates (rows, cols)"""
+
+    dtype = np.float64 if scene is None else scene.dtype
+    rng = None if pruning is None else pruning.generator(int(rows[0]), int(cols[0]))
+    origins, directions = sample_rays(width, height, rows, cols, dtype)
+    return trace_rays(origins, directions, max_depth, scene, pruning=pruning, rng=rng)
+
+
+def render_image_batch(width, height, max_depth=3, scene=None):
+    """Render the whole frame as a single batch of (height * width) rays"""
+
+    return render_tile(width, height, 0, 0, height, width, max_depth, scene)
+
+
+def render_gbuffer(width, height, max_depth=3, scene=None):
+    """GBuffer of the whole frame, for relighting with 'shade_gbuffer'.
+
+    The colors it gives are the pixels in rows, reshape them to
+    (height, width, 3) for an image
+    """
+
+    origins, directions = primary_rays(
+        width, height, dtype=np.float64 if scene is None else scene.dtype
+    )
+    return trace_gbuffer(origins, directions, max_depth, scene)
+
+
+def render_image_per_pixel(width, height, max_depth=3):
+    """Reference renderer that traces the frame one pixel at a time"""
 
-    camera = np.array([0, 0, 1])
     ratio = float(width) / height
     screen = (-1, 1 / ratio, 1, -1 / ratio)  # left, top, right, bottom
 
@@ -123,14 +664,15 @@ def render_image(w, h):
                 shifted_point = intersection + 1e-5 * normal_to_surface
                 intersection_to_light = normalize(light["position"] - shifted_point)
 
-                _, min_distance = nearest_intersected_object(
-                    objects, shifted_point, intersection_to_light
-                )
-
                 intersection_to_light_distance = np.linalg.norm(
                     light["position"] - intersection
                 )
-                is_shadowed = min_distance < intersection_to_light_distance
+                is_shadowed = any_intersected_object(
+                    objects,
+                    shifted_point,
+                    intersection_to_light,
+                    intersection_to_light_distance,
+                )
 
                 if is_shadowed:
                     break
@@ -167,9 +709,54 @@ def render_image(w, h):
                 direction = reflected(direction, normal_to_surface)
             image[i, j] = np.clip(color, 0, 1)
         print("%d/%d" % (i + 1, height))
-    plt.imsave("image.png", image)
+    return image
 
+
+def render_image(w, h, batch=True, workers=1, tile_size=DEFAULT_TILE_SIZE, cache=None):
+    """Render the default scene and save it as image.png.
+
+    With a RenderCache an unchanged scene is not rendered again and the
+    cached frame is returned as is, image.png is then left alone
+    """
+
+    key = None
+    if cache is not None:
+        key = content_hash("render_image", ENGINE_VERSION, w, h, objects, light, camera)
+        image = cache.get(key)
+        if image is not None:
+            return image
+
+    if workers != 1:
+        image = render_parallel(render_tile, w, h, workers=workers, tile_size=tile_size)
+    elif batch:
+        image = render_image_batch(w, h)
+    else:
+        image = render_image_per_pixel(w, h)
+    save_image("image.png", image)
+
+    if key is not None:
+        cache.put(key, image)
     return image
 
 
+def render_image_to_file(
+    w, h, path="image.png", workers=1, tile_size=DEFAULT_TILE_SIZE
+):
+    """Render the default scene straight into a .ppm or .png file.
+
+    Tiles are written as soon as they are rendered, so memory is bounded by
+    the tile size instead of the frame size and an interrupted render leaves
+    the finished tiles on disk
+    """
+
+    with open_image(path, w, h) as writer:
+        if workers != 1:
+            render_parallel(
+                render_tile, w, h, workers=workers, tile_size=tile_size, writer=writer
+            )
+            return
+        for top, left, bottom, right in tiles(w, h, tile_size):
+            writer.write(top, left, render_tile(w, h, top, left, bottom, right))
+
+
 # render_image(1280, 720)
@@ -1,9 +1,7 @@
-from asyncio import exceptions
-from re import X
-from matplotlib.pyplot import xscale
 import numpy as np
-import matplotlib as plt
-from numpy.linalg import norm
+from utils import jit
+from utils.imageio import open_image
+from utils.parallel import DEFAULT_TILE_SIZE, render_parallel
 
 
 def cross(v1, v2):
@@ -102,6 +100,9 @@ SPHERES = (
 
 LIGHTS = (Vector3(-20, 20, 20), Vector3(30, 50, -25), Vector3(30, 20, 30))
 
+# Deepest bounce 'cast_ray' still shades, deeper rays see the background
+MAX_DEPTH = 4
+
 
 def reflect(I, N):
     return I - N * 2.0 * (I * N)
@@ -173,23 +174,65 @@ def scene_intersect(orig, dir) -> tuple:
     return (nearest_dist < 1000, pt, N, material)
 
 
-def cast_ray(orig, dir, depth=0):
-    hit, point, N, material = scene_intersect(orig, dir)
-    if depth > 4 or not hit:
-        return Vector3(0.2, 0.7, 0.8)
+def scene_occluded(orig, dir, max_dist) -> tuple:
+    """Any-hit version of 'scene_intersect' for shadow rays.
+
+    Returns whether the plane or a sphere is hit closer than 'max_dist' and
+    the number of objects tested until the first blocker was found. No hit
+    point, normal or material is built
+    """
 
-    reflect_dir = (reflect(dir, N)).normalized()
-    refract_dir = (refract(dir, N, material.refractive_index)).normalized()
-    reflect_color = cast_ray(point, reflect_dir, depth + 1)
-    refract_color = cast_ray(point, refract_dir, depth + 1)
+    # hits further than 1000 are misses for 'scene_intersect' too
+    max_dist = min(max_dist, 1000)
+    if abs(dir[1]) > 0.001:
+        d = -(orig[1] + 4) / dir[1]
+        if d > 0.001 and d < max_dist:
+            p = orig + dir * d
+            if abs(p[0]) < 10 and p[2] < -10 and p[2] > -30:
+                return (True, 1)
 
-    diffuse_light_intensity = (0,)
+    for tests, sphere in enumerate(SPHERES, 2):
+        intersection, d = ray_sphere_intersect(orig, dir, sphere)
+        if intersection and d < max_dist:
+            return (True, tests)
+    return (False, len(SPHERES) + 1)
+
+
+def _cast_secondary(cast, kind, weight, pruning, rng):
+    # black for rays that can't change the pixel or that 'pruning' terminates
+    if weight <= 0:
+        return Vector3(0, 0, 0)
+    scale = 1.0 if pruning is None else pruning.survive(weight, rng)
+    if scale == 0:
+        return Vector3(0, 0, 0)
+    color = cast(kind, weight * scale)
+    return color if scale == 1.0 else color * scale
+
+
+def shade(dir, point, N, material, lights, weight, cast, occluded, pruning, rng):
+    """Color of a hit seen along 'dir', shared by 'cast_ray' and 'shade_gbuffer'.
+
+    'cast(kind, weight)' gives the color of the "reflection" or "refraction"
+    ray of the hit, it is only called for the rays that survive 'pruning'.
+    'occluded(light, light_dir)' tells whether the hit is in the shadow of
+    a light
+    """
+
+    reflect_color = refract_color = Vector3(0, 0, 0)
+    if material.albedo[2]:
+        reflect_color = _cast_secondary(
+            cast, "reflection", weight * material.albedo[2], pruning, rng
+        )
+    if material.albedo[3]:
+        refract_color = _cast_secondary(
+            cast, "refraction", weight * material.albedo[3], pruning, rng
+        )
+
+    diffuse_light_intensity = 0
     specular_light_intensity = 0
-    for light in LIGHTS:
+    for light in lights:
         light_dir = (light - point).normalized()
-        hit, shadow_pt, trashrm, trashmat = scene_intersect(point, light_dir)
-
-        if hit and (shadow_pt - point).norm() < (light - point).norm():
+        if occluded(light, light_dir):
             continue
 
         diffuse_light_intensity += max(0.0, light_dir * N)
@@ -205,33 +248,328 @@ def cast_ray(orig, dir, depth=0):
     )
 
 
-def _main():
-    width = 1280
-    height = 720
-    fov = 1.05
+def cast_ray(
+    orig,
+    dir,
+    depth=0,
+    stats=None,
+    kind="primary",
+    weight=1.0,
+    pruning=None,
+    rng=None,
+):
+    """Color seen along a ray, 'weight' is the factor it is added to its pixel with.
+
+    Secondary rays are only cast for materials that reflect or refract,
+    with a RayPruning 'pruning' rays of low weight are terminated
+    """
+
+    hit, point, N, material = scene_intersect(orig, dir)
+    if stats is not None:
+        # the plane and every sphere are tested
+        stats.count(kind, 1, int(hit), len(SPHERES) + 1, depth)
+    if depth > MAX_DEPTH or not hit:
+        return Vector3(0.2, 0.7, 0.8)
+
+    def cast(kind, weight):
+        if kind == "reflection":
+            child = (reflect(dir, N)).normalized()
+        else:
+            child = (refract(dir, N, material.refractive_index)).normalized()
+        return cast_ray(point, child, depth + 1, stats, kind, weight, pruning, rng)
+
+    def occluded(light, light_dir):
+        shadowed, tests = scene_occluded(point, light_dir, (light - point).norm())
+        if stats is not None:
+            stats.count("shadow", 1, int(shadowed), tests)
+        return shadowed
+
+    return shade(dir, point, N, material, LIGHTS, weight, cast, occluded, pruning, rng)
+
+
+FOV = 1.05
+# Bump when a change alters the rendered pixels, it invalidates cached frames
+ENGINE_VERSION = 1
+# 'render_tile' runs the kernels of utils.kernels when utils.jit enables them
+JIT_KERNELS = True
+
+
+def render_tile(
+    width, height, top, left, bottom, right, fov=FOV, stats=None, pruning=None
+):
+    """Render pixels [top:bottom, left:right] of a width x height frame.
+
+    With utils.jit enabled the tile is rendered by 'kernels.whitted_pixels',
+    unless 'stats' or the Russian roulette of 'pruning' need 'cast_ray'
+    """
+
+    if jit.enabled() and stats is None and (pruning is None or not pruning.roulette):
+        rows, cols = np.mgrid[top:bottom, left:right]
+        colors = _render_samples_jit(
+            width, height, rows.ravel(), cols.ravel(), fov, pruning
+        )
+        return colors.reshape(bottom - top, right - left, 3)
+
+    rng = None if pruning is None else pruning.generator(top, left)
+    tile = np.zeros((bottom - top, right - left, 3))
+    cost = np.zeros((bottom - top, right - left))
+    dir_z = -height / (2.0 * np.tan(fov / 2.0))
+    for i in range(top, bottom):
+        for j in range(left, right):
+            dir_x = (j + 0.5) - width / 2
+            dir_y = -(i + 0.5) + height / 2
+            if stats is None:
+                color = cast_ray(
+                    Vector3(0, 0, 0),
+                    Vector3(dir_x, dir_y, dir_z).normalized(),
+                    pruning=pruning,
+                    rng=rng,
+                )
+            else:
+                tests = stats.intersection_tests
+                with stats.timer("trace"):
+                    color = cast_ray(
+                        Vector3(0, 0, 0),
+                        Vector3(dir_x, dir_y, dir_z).normalized(),
+                        stats=stats,
+                        pruning=pruning,
+                        rng=rng,
+                    )
+                cost[i - top][j - left] = stats.intersection_tests - tests
+            tile[i - top][j - left] = vector3_to_nparray(color)
+
+    if stats is not None:
+        stats.add_cost(top, left, cost)
+    return tile
+
+
+def render_samples(width, height, rows, cols, fov=FOV, pruning=None):
+    """(N, 3) colors of the rays through the (fractional) pixel coordinates (rows, cols)"""
+
+    if jit.enabled() and (pruning is None or not pruning.roulette):
+        return _render_samples_jit(width, height, rows, cols, fov, pruning)
+
+    rng = None if pruning is None else pruning.generator(int(rows[0]), int(cols[0]))
+    colors = np.empty((len(rows), 3))
+    dir_z = -height / (2.0 * np.tan(fov / 2.0))
+    for sample, (i, j) in enumerate(zip(rows, cols)):
+        dir_x = (j + 0.5) - width / 2
+        dir_y = -(i + 0.5) + height / 2
+        color = cast_ray(
+            Vector3(0, 0, 0),
+            Vector3(dir_x, dir_y, dir_z).normalized(),
+            pruning=pruning,
+            rng=rng,
+        )
+        colors[sample] = vector3_to_nparray(color)
+    return colors
+
+
+def _render_samples_jit(width, height, rows, cols, fov, pruning):
+    from utils import kernels
+    from utils.wavefront import WhittedScene
+
+    scene = WhittedScene()
+    colors = np.empty((len(rows), 3))
+    with jit.KERNEL_LOCK:
+        kernels.whitted_pixels(
+            width,
+            height,
+            rows,
+            cols,
+            fov,
+            scene.centers,
+            scene.radii,
+            scene.material_index,
+            scene.plane_material,
+            scene.albedo,
+            scene.diffuse_color,
+            scene.refractive_index,
+            scene.specular_exponent,
+            scene.lights,
+            scene.background,
+            MAX_DEPTH,
+            0.0 if pruning is None else pruning.min_contribution,
+            colors,
+        )
+    return colors
+
+
+# children of a RayHit that no shading reached yet
+_UNTRACED = object()
 
-    image = np.zeros((height, width, 3))
 
-    for i in range(height):
-        for j in range(width):
-            dir_x = (i + 0.5) - width / 2
-            dir_y = -(j + 0.5) + height / 2
-            dir_z = -height / (2.0 * np.tan(fov / 2.0))
-            color = cast_ray(
-                Vector3(0, 0, 0), Vector3(dir_x, dir_y, dir_z).normalized()
+class RayHit:
+    """Hit of a ray of a GBuffer tree: direction, point, normal and material.
+
+    The hits of the reflected and refracted rays it spawns are traced on
+    first use, None stands for the background. Refraction follows the
+    refractive index the material had when the hit was traced
+    """
+
+    def __init__(self, dir, point, N, material, depth):
+        self.dir = dir
+        self.point = point
+        self.N = N
+        self.material = material
+        self.depth = depth
+        self.refractive_index = material.refractive_index
+        self._reflected = self._refracted = _UNTRACED
+
+    def reflected(self):
+        if self._reflected is _UNTRACED:
+            self._reflected = trace_hit(
+                self.point, (reflect(self.dir, self.N)).normalized(), self.depth + 1
+            )
+        return self._reflected
+
+    def refracted(self):
+        if self._refracted is _UNTRACED:
+            self._refracted = trace_hit(
+                self.point,
+                (refract(self.dir, self.N, self.refractive_index)).normalized(),
+                self.depth + 1,
             )
-            # maximum = max(1.0, max(color[0], max(color[1], color[2])))
-            # for i in range(3):
-            #     color[i] = 255 * color[i] / maximum
-            # print(f"{color[0]},{color[1]},{color[2]}")
-            try:
-                image[i][j] = vector3_to_nparray(color)
-            except Exception as e:
-                pass
+        return self._refracted
+
+
+def trace_hit(orig, dir, depth=0):
+    """RayHit of a ray, None when it sees the background like in 'cast_ray'"""
+
+    hit, point, N, material = scene_intersect(orig, dir)
+    if depth > MAX_DEPTH or not hit:
+        return None
+    return RayHit(dir, point, N, material, depth)
+
+
+class GBuffer:
+    """Ray trees of the pixels [top:bottom, left:right] of a frame, without lights.
+
+    'hits' holds the RayHit of the primary ray of every pixel, row by row.
+    Secondary rays are traced the first time a shading reaches them and
+    kept, so moving lights and editing the color, albedo or specular
+    exponent of the materials only re-shades (an albedo that becomes non
+    zero traces the new branches). Refraction directions depend on the
+    refractive index, after editing one trace a new GBuffer. Shadow rays
+    are kept per light position
+    """
+
+    def __init__(self, top, left, bottom, right, hits):
+        self.top = top
+        self.left = left
+        self.bottom = bottom
+        self.right = right
+        self.hits = hits
+        # {light position: {RayHit: shadowed}} of the lights last shaded with
+        self._shadows = {}
+
+    def shadow_caches(self, lights):
+        """Shadow caches of 'lights', the ones of lights no longer there are dropped"""
+
+        keys = [(light[0], light[1], light[2]) for light in lights]
+        self._shadows = {key: self._shadows.get(key, {}) for key in keys}
+        return [self._shadows[key] for key in keys]
+
+    def depth(self):
+        """Distance of every pixel to its first hit, inf for the background"""
+
+        depth = np.full((self.bottom - self.top, self.right - self.left), np.inf)
+        for pixel, hit in enumerate(self.hits):
+            if hit is not None:
+                # primary rays start at the origin
+                depth.flat[pixel] = hit.point.norm()
+        return depth
+
+
+def trace_gbuffer(width, height, top, left, bottom, right, fov=FOV):
+    """Visibility part of 'render_tile': the GBuffer of its pixels"""
+
+    hits = []
+    dir_z = -height / (2.0 * np.tan(fov / 2.0))
+    for i in range(top, bottom):
+        for j in range(left, right):
+            dir_x = (j + 0.5) - width / 2
+            dir_y = -(i + 0.5) + height / 2
+            hits.append(
+                trace_hit(Vector3(0, 0, 0), Vector3(dir_x, dir_y, dir_z).normalized())
+            )
+    return GBuffer(top, left, bottom, right, hits)
+
+
+def shade_gbuffer(gbuffer, lights=None, pruning=None):
+    """Shading part of 'render_tile': the tile of a GBuffer.
 
-        print(f"{i + 1}/{height}")
+    'lights' (by default LIGHTS) and the materials may have changed since
+    the GBuffer was traced, but for refractive indices. Only shadow rays
+    that no shading traced for the light position yet are traced. Gives the
+    pixels of 'render_tile' without utils.jit, with the same 'pruning'
+    """
 
-    plt.imsave("text.png", image)
+    lights = LIGHTS if lights is None else lights
+    # Vector3 hashes by identity, the lights of this shading are the keys
+    caches = dict(zip(lights, gbuffer.shadow_caches(lights)))
+    rng = None if pruning is None else pruning.generator(gbuffer.top, gbuffer.left)
+    tile = np.zeros((gbuffer.bottom - gbuffer.top, gbuffer.right - gbuffer.left, 3))
+    for pixel, hit in enumerate(gbuffer.hits):
+        color = _shade_hit(hit, lights, caches, 1.0, pruning, rng)
+        tile.reshape(-1, 3)[pixel] = vector3_to_nparray(color)
+    return tile
+
+
+def _shade_hit(hit, lights, caches, weight, pruning, rng):
+    # 'cast_ray' for a traced hit
+    if hit is None:
+        return Vector3(0.2, 0.7, 0.8)
+
+    def cast(kind, weight):
+        child = hit.reflected() if kind == "reflection" else hit.refracted()
+        return _shade_hit(child, lights, caches, weight, pruning, rng)
+
+    def occluded(light, light_dir):
+        shadows = caches[light]
+        shadowed = shadows.get(hit)
+        if shadowed is None:
+            shadowed, _ = scene_occluded(
+                hit.point, light_dir, (light - hit.point).norm()
+            )
+            shadows[hit] = shadowed
+        return shadowed
+
+    return shade(
+        hit.dir,
+        hit.point,
+        hit.N,
+        hit.material,
+        lights,
+        weight,
+        cast,
+        occluded,
+        pruning,
+        rng,
+    )
+
+
+def _main(workers=1, tile_size=DEFAULT_TILE_SIZE):
+    width = 1280
+    height = 720
+
+    # rows go to the file as they finish, an interrupted run keeps them
+    with open_image("text.png", width, height) as writer:
+        if workers == 1:
+            for i in range(height):
+                writer.write(i, 0, render_tile(width, height, i, 0, i + 1, width))
+                print(f"{i + 1}/{height}")
+        else:
+            render_parallel(
+                render_tile,
+                width,
+                height,
+                workers=workers,
+                tile_size=tile_size,
+                progress=lambda done, total: print(f"{done}/{total}"),
+                writer=writer,
+            )
 
 
-_main()
+if __name__ == "__main__":
+    _main()
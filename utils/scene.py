@@ -0,0 +1,368 @@
+import numpy as np
+
+# Upper bound for the number of (ray, sphere) pairs tested in one array expression
+MAX_PAIRS_PER_CHUNK = 1 << 22
+# Primitives an occlusion query tests at once before dropping the blocked rays
+OCCLUSION_BLOCK = 64
+
+
+class Scene:
+    """Spheres packed into contiguous arrays (struct of arrays).
+
+    Every sphere is a row in 'centers'/'radii' and an index into the material
+    table, so a sphere costs 3 + 1 floats and one int32 regardless of how many
+    spheres share the same material
+    """
+
+    def __init__(
+        self,
+        centers,
+        radii,
+        material_index,
+        ambient,
+        diffuse,
+        specular,
+        shininess,
+        reflection,
+        dtype=np.float64,
+    ):
+        self.dtype = np.dtype(dtype)
+
+        # per sphere
+        self.centers = np.ascontiguousarray(centers, dtype=self.dtype).reshape(-1, 3)
+        self.radii = np.ascontiguousarray(radii, dtype=self.dtype).reshape(-1)
+        self.material_index = np.ascontiguousarray(material_index, dtype=np.int32)
+
+        # per material
+        self.ambient = np.ascontiguousarray(ambient, dtype=self.dtype).reshape(-1, 3)
+        self.diffuse = np.ascontiguousarray(diffuse, dtype=self.dtype).reshape(-1, 3)
+        self.specular = np.ascontiguousarray(specular, dtype=self.dtype).reshape(-1, 3)
+        self.shininess = np.ascontiguousarray(shininess, dtype=self.dtype)
+        self.reflection = np.ascontiguousarray(reflection, dtype=self.dtype)
+
+        # |center|^2 - radius^2, the ray independent part of the quadratic.
+        # Computed in float64: for large spheres both terms are huge and
+        # nearly cancel, float32 would lose all significant digits
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+        self._center_term = (
+            np.einsum("ij,ij->i", centers, centers) - radii**2
+        ).astype(self.dtype)
+
+        self.bvh = None
+
+    @classmethod
+    def from_objects(cls, objects, dtype=np.float64):
+        """Adapter for the dict based scenes of utils.raytracing"""
+
+        materials = {}
+        material_index = []
+        for obj in objects:
+            key = (
+                tuple(np.ravel(obj["ambient"])),
+                tuple(np.ravel(obj["diffuse"])),
+                tuple(np.ravel(obj["specular"])),
+                obj["shininess"],
+                obj["reflection"],
+            )
+            material_index.append(materials.setdefault(key, len(materials)))
+
+        table = list(materials)
+        return cls(
+            centers=[obj["center"] for obj in objects],
+            radii=[obj["radius"] for obj in objects],
+            material_index=material_index,
+            ambient=[m[0] for m in table],
+            diffuse=[m[1] for m in table],
+            specular=[m[2] for m in table],
+            shininess=[m[3] for m in table],
+            reflection=[m[4] for m in table],
+            dtype=dtype,
+        )
+
+    @classmethod
+    def random(cls, count, seed=0, dtype=np.float64):
+        """Random spheres in front of the camera of utils.raytracing, for benchmarks"""
+
+        rng = np.random.default_rng(seed)
+        lo, hi = np.array([-1.5, -1, -4]), np.array([1.5, 1, -1])
+        radius = 0.5 * np.prod(hi - lo) ** (1 / 3) / np.cbrt(count)
+        return cls(
+            centers=rng.uniform(lo, hi, (count, 3)),
+            radii=rng.uniform(0.5, 1, count) * radius,
+            material_index=rng.integers(0, 4, count),
+            ambient=rng.uniform(0, 0.1, (4, 3)),
+            diffuse=rng.uniform(0, 0.7, (4, 3)),
+            specular=np.ones((4, 3)),
+            shininess=np.full(4, 100),
+            reflection=np.full(4, 0.5),
+            dtype=dtype,
+        )
+
+    def __len__(self):
+        return len(self.radii)
+
+    @property
+    def nbytes(self):
+        """Memory used by the sphere and material arrays"""
+
+        return sum(
+            array.nbytes
+            for array in (
+                self.centers,
+                self.radii,
+                self.material_index,
+                self._center_term,
+                self.ambient,
+                self.diffuse,
+                self.specular,
+                self.shininess,
+                self.reflection,
+            )
+        )
+
+    @property
+    def bytes_per_object(self):
+        """Memory cost of a single sphere, material table excluded"""
+
+        return (
+            self.centers.itemsize * 3
+            + self.radii.itemsize
+            + self.material_index.itemsize
+            + self._center_term.itemsize
+        )
+
+    def content(self):
+        """Arrays that determine how the scene renders, for cache keys"""
+
+        return (
+            self.centers,
+            self.radii,
+            self.material_index,
+            self.ambient,
+            self.diffuse,
+            self.specular,
+            self.shininess,
+            self.reflection,
+        )
+
+    def build_bvh(self, leaf_size=4, bins=16):
+        """Build a bounding volume hierarchy that 'intersect' uses from now on"""
+
+        from utils.bvh import BVH
+
+        radii = self.radii[:, np.newaxis]
+        self.bvh = BVH(
+            self.centers - radii, self.centers + radii, leaf_size, bins, self.dtype
+        )
+        return self.bvh
+
+    def intersect(self, ray_origins, ray_directions, cost=None):
+        """Nearest sphere for every ray of (N, 3) origins and normalized directions.
+
+        Returns index of the nearest sphere (-1 when nothing is hit) and the
+        distance to it (inf when nothing is hit). Rays are processed in chunks
+        so that at most MAX_PAIRS_PER_CHUNK ray/sphere pairs exist at once.
+        The intersection tests spent on every ray are added to 'cost' if given
+        """
+
+        if self.bvh is not None:
+            return self.bvh.intersect(
+                ray_origins, ray_directions, self._sphere_distances, cost
+            )
+
+        if cost is not None:
+            cost += len(self)
+
+        count = len(ray_origins)
+        nearest = np.full(count, -1)
+        min_distance = np.full(count, np.inf, dtype=self.dtype)
+        if count == 0 or len(self) == 0:
+            return nearest, min_distance
+
+        chunk = max(1, MAX_PAIRS_PER_CHUNK // len(self))
+        for start in range(0, count, chunk):
+            stop = min(start + chunk, count)
+            index, distance = self._intersect_chunk(
+                ray_origins[start:stop], ray_directions[start:stop]
+            )
+            nearest[start:stop] = index
+            min_distance[start:stop] = distance
+        return nearest, min_distance
+
+    def occluded(self, ray_origins, ray_directions, max_distance, cost=None):
+        """Whether every ray hits any sphere in (0, max_distance), for shadow rays.
+
+        An any-hit query: nothing is known about which sphere blocks a ray or
+        where, and a ray is not tested further once a blocker is found.
+        Spheres are tested in blocks of OCCLUSION_BLOCK, or by
+        the BVH if there is one. 'max_distance' is a scalar or one distance
+        per ray, the tests spent on every ray are added to 'cost' if given
+        """
+
+        count = len(ray_origins)
+        max_distance = np.broadcast_to(max_distance, (count,))
+        if self.bvh is not None:
+            return self.bvh.occluded(
+                ray_origins,
+                ray_directions,
+                self._sphere_distances,
+                max_distance,
+                cost,
+            )
+
+        blocked = np.zeros(count, dtype=bool)
+        if count == 0 or len(self) == 0:
+            return blocked
+
+        block = min(len(self), OCCLUSION_BLOCK)
+        chunk = max(1, MAX_PAIRS_PER_CHUNK // block)
+        for start in range(0, count, chunk):
+            stop = min(start + chunk, count)
+            rays = np.arange(start, stop)
+            origins, directions = ray_origins[start:stop], ray_directions[start:stop]
+            limit = max_distance[start:stop, np.newaxis]
+            for first in range(0, len(self), block):
+                spheres = slice(first, min(first + block, len(self)))
+                if cost is not None:
+                    cost[rays] += spheres.stop - spheres.start
+
+                distances = self._sphere_distances(origins, directions, spheres)
+                hit = (distances < limit).any(axis=1)
+                blocked[rays[hit]] = True
+                if spheres.stop == len(self) or hit.all():
+                    break
+                if hit.any():
+                    rays, limit = rays[~hit], limit[~hit]
+                    origins, directions = origins[~hit], directions[~hit]
+        return blocked
+
+    def normals(self, index, points, directions):
+        """Unit surface normals of the spheres 'index' at 'points'"""
+
+        normals = points - self.centers[index]
+        return normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+    def object_ids(self, index):
+        """Object every primitive 'index' belongs to, -1 for none, for edge detection"""
+
+        return index
+
+    def _sphere_distances(self, ray_origins, ray_directions, spheres=slice(None)):
+        """(rays, spheres) distances to the selected spheres, inf for misses"""
+
+        centers = self.centers[spheres]
+
+        # |o + t*d - c|^2 = r^2  ->  t^2 + b*t + c = 0 for every (ray, sphere) pair
+        b = 2 * (
+            np.einsum("ij,ij->i", ray_directions, ray_origins)[:, np.newaxis]
+            - ray_directions @ centers.T
+        )
+        c = (
+            np.einsum("ij,ij->i", ray_origins, ray_origins)[:, np.newaxis]
+            - 2 * (ray_origins @ centers.T)
+            + self._center_term[spheres]
+        )
+        delta = b**2 - 4 * c
+        sqrt_delta = np.sqrt(np.maximum(delta, 0))
+        # both roots without subtracting nearly equal numbers: for a ray close
+        # to a large sphere (-b - sqrt_delta) / 2 would cancel catastrophically
+        q = -0.5 * (b + np.copysign(sqrt_delta, b))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = np.maximum(q, c / q)
+            t2 = np.minimum(q, c / q)
+        return np.where((delta > 0) & (t1 > 0) & (t2 > 0), t2, np.inf)
+
+    def _intersect_chunk(self, ray_origins, ray_directions):
+        distances = self._sphere_distances(ray_origins, ray_directions)
+        nearest = np.argmin(distances, axis=1)
+        min_distance = distances[np.arange(len(nearest)), nearest]
+        return np.where(np.isfinite(min_distance), nearest, -1), min_distance
+
+
+class SceneGroup:
+    """Several scenes ('Scene', 'TriangleMesh') rendered together as one.
+
+    Primitives and materials of the parts are numbered one part after the
+    other. Every query is answered by the parts and their own BVHs, an
+    occlusion query stops at the first part that blocks a ray
+    """
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.dtype = self.parts[0].dtype
+        if any(part.dtype != self.dtype for part in self.parts):
+            raise ValueError("All parts of a SceneGroup need the same dtype")
+
+        sizes = [len(part) for part in self.parts]
+        self._offsets = np.concatenate(([0], np.cumsum(sizes)))
+        material_offsets = np.cumsum([0] + [len(part.ambient) for part in self.parts])
+        self.material_index = np.concatenate(
+            [
+                part.material_index + offset
+                for part, offset in zip(self.parts, material_offsets)
+            ]
+        )
+        for name in ("ambient", "diffuse", "specular", "shininess", "reflection"):
+            setattr(
+                self,
+                name,
+                np.concatenate([getattr(part, name) for part in self.parts]),
+            )
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    @property
+    def nbytes(self):
+        return sum(part.nbytes for part in self.parts)
+
+    def content(self):
+        return tuple(self.parts)
+
+    def _ranges(self, index):
+        for part, start, stop in zip(self.parts, self._offsets, self._offsets[1:]):
+            yield part, start, (index >= start) & (index < stop)
+
+    def intersect(self, ray_origins, ray_directions, cost=None):
+        """Nearest primitive of all parts, see 'Scene.intersect'"""
+
+        nearest = np.full(len(ray_origins), -1)
+        min_distance = np.full(len(ray_origins), np.inf, dtype=self.dtype)
+        for part, start in zip(self.parts, self._offsets):
+            index, distance = part.intersect(ray_origins, ray_directions, cost)
+            closer = distance < min_distance
+            nearest[closer] = index[closer] + start
+            min_distance[closer] = distance[closer]
+        return nearest, min_distance
+
+    def occluded(self, ray_origins, ray_directions, max_distance, cost=None):
+        """Whether any part blocks every ray, see 'Scene.occluded'"""
+
+        max_distance = np.broadcast_to(max_distance, (len(ray_origins),))
+        blocked = np.zeros(len(ray_origins), dtype=bool)
+        rays = np.arange(len(ray_origins))
+        for part in self.parts:
+            ray_cost = None if cost is None else np.zeros(len(rays), dtype=cost.dtype)
+            hit = part.occluded(
+                ray_origins[rays], ray_directions[rays], max_distance[rays], ray_cost
+            )
+            if cost is not None:
+                cost[rays] += ray_cost
+            blocked[rays[hit]] = True
+            rays = rays[~hit]
+        return blocked
+
+    def normals(self, index, points, directions):
+        normals = np.empty(points.shape, dtype=self.dtype)
+        for part, start, mine in self._ranges(index):
+            normals[mine] = part.normals(
+                index[mine] - start, points[mine], directions[mine]
+            )
+        return normals
+
+    def object_ids(self, index):
+        ids = np.full(len(index), -1)
+        for part, start, mine in self._ranges(index):
+            ids[mine] = part.object_ids(index[mine] - start) + start
+        return ids
@@ -1,32 +1,96 @@
 import math
+from functools import lru_cache
 import numpy as np
 
+# Number of (degree, samples) basis matrices kept by 'bernstein_basis'
+BASIS_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=BASIS_CACHE_SIZE)
+def bernstein_basis(degree, samples):
+    """(samples x degree + 1) matrix of Bernstein polynomials at uniform t in [0, 1]"""
+
+    t = np.linspace(0, 1, samples)[:, np.newaxis]
+    i = np.arange(degree + 1)
+    coefficients = np.array([math.comb(degree, k) for k in i], dtype=float)
+
+    basis = coefficients * t**i * (1 - t) ** (degree - i)
+    # shared between calls, so it must not be changed in place
+    basis.setflags(write=False)
+    return basis
+
 
 def bezier(points, pts_to_calc=100):
-    result = np.zeros([pts_to_calc, 2])
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) == 0:
+        return np.zeros([0, 2])
+
+    return bernstein_basis(len(points) - 1, pts_to_calc) @ points
+
+
+def bezier_move_point(curve, degree, index, delta):
+    """Update a curve from 'bezier' in place after control point 'index' moved by 'delta'.
+
+    Samples are linear in the control points, so the change is basis column
+    'index' times 'delta', O(samples) instead of a full re-evaluation
+    """
+
+    curve += np.outer(bernstein_basis(degree, len(curve))[:, index], delta)
+    return curve
+
+
+# Subdivision depth limit of 'bezier_adaptive', at most 2^16 segments
+MAX_SUBDIVISIONS = 16
+
+
+def _split(points):
+    """De Casteljau subdivision of a Bezier curve at t = 0.5"""
+
+    left, right = [points[0]], [points[-1]]
+    level = points
+    while len(level) > 1:
+        level = (level[:-1] + level[1:]) / 2
+        left.append(level[0])
+        right.append(level[-1])
+    return np.array(left), np.array(right[::-1])
+
 
-    Ni = lambda n, i: math.factorial(n) / (math.factorial(i) * math.factorial(n - i))
-    Basis = lambda n, i, t: Ni(n, i) * math.pow(t, i) * math.pow(1 - t, n - i)
+def _flatness(points):
+    """Largest distance of the control points from the chord.
 
-    npts = len(points)
-    cpts = len(result)
+    The curve lies in the convex hull of its control points, so this bounds
+    the distance between the curve and the chord
+    """
 
-    count = 0
-    j = np.zeros([1, npts], float)
+    start, chord = points[0], points[-1] - points[0]
+    offsets = points[1:-1] - start
+    length2 = chord @ chord
+    if length2 > 0:
+        t = np.clip(offsets @ chord / length2, 0, 1)
+        offsets = offsets - t[:, np.newaxis] * chord
+    return np.sqrt((offsets**2).sum(axis=1).max(initial=0))
 
-    t = 0
-    step = 1 / (cpts - 1)
 
-    while t <= 1:
-        for i in range(1, npts + 1):
-            j[0][i - 1] = Basis(npts - 1, i - 1, t)
+def bezier_adaptive(points, tolerance):
+    """Flatten a Bezier curve into a polyline deviating from it by at most 'tolerance'.
 
-        temp = j.dot(points)
+    Segments are split in half until their control polygon is flat enough,
+    so straight stretches get few vertices and tight bends get many
+    """
 
-        result[count][0] = temp[0][0]
-        result[count][1] = temp[0][1]
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) == 0:
+        return np.zeros([0, 2])
 
-        t += step
-        count += 1
+    result = [points[0]]
+    stack = [(points, 0)]
+    while stack:
+        segment, depth = stack.pop()
+        if depth >= MAX_SUBDIVISIONS or _flatness(segment) <= tolerance:
+            result.append(segment[-1])
+            continue
 
-    return result
+        left, right = _split(segment)
+        stack.append((right, depth + 1))
+        stack.append((left, depth + 1))
+    return np.array(result)
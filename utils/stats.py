@@ -0,0 +1,90 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+import numpy as np
+
+_DISABLED = nullcontext()
+
+
+class RenderStats:
+    """Counters collected by a renderer when it is given a 'stats' object.
+
+    Rays and intersection tests are counted by type (primary, shadow,
+    reflection, refraction), together with hits and misses, a histogram of the
+    bounce depth at which rays hit and wall-clock time per stage. With a
+    frame size it also keeps the intersection tests spent on every pixel
+    """
+
+    def __init__(self, width=None, height=None):
+        self.rays = Counter()
+        self.intersection_tests = 0
+        self.tests = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.depth = Counter()
+        self.timers = defaultdict(float)
+        self.cost = None if width is None else np.zeros((height, width))
+
+    def count(self, kind, rays, hits, tests=0, depth=None):
+        self.rays[kind] += rays
+        self.hits += hits
+        self.misses += rays - hits
+        self.intersection_tests += tests
+        self.tests[kind] += tests
+        if depth is not None:
+            self.depth[depth] += hits
+
+    def add_cost(self, top, left, cost):
+        """Add the per pixel intersection tests of a (rows, columns) tile"""
+
+        if self.cost is not None:
+            self.cost[top : top + cost.shape[0], left : left + cost.shape[1]] += cost
+
+    def add_sample_cost(self, rows, cols, cost):
+        """Add the cost of samples at fractional pixel coordinates to their pixels"""
+
+        if self.cost is not None:
+            height, width = self.cost.shape
+            rows = np.clip(np.rint(rows).astype(int), 0, height - 1)
+            cols = np.clip(np.rint(cols).astype(int), 0, width - 1)
+            np.add.at(self.cost, (rows, cols), cost)
+
+    @contextmanager
+    def timer(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += perf_counter() - start
+
+    def report(self):
+        """Human readable summary of all counters"""
+
+        lines = [
+            "rays: "
+            + ", ".join(f"{kind} {count}" for kind, count in sorted(self.rays.items())),
+            f"intersection tests: {self.intersection_tests} ("
+            + ", ".join(f"{kind} {count}" for kind, count in sorted(self.tests.items()))
+            + ")",
+            f"hits: {self.hits}, misses: {self.misses}",
+            "hits by bounce depth: "
+            + ", ".join(
+                f"{depth}: {count}" for depth, count in sorted(self.depth.items())
+            ),
+        ]
+        lines += [f"{stage}: {seconds:.3f} s" for stage, seconds in self.timers.items()]
+        return "\n".join(lines)
+
+    def heatmap(self):
+        """Per pixel cost as a black-red-yellow-white RGB image, log scaled"""
+
+        cost = np.log1p(self.cost)
+        cost /= max(cost.max(), 1e-12)
+        return np.clip(np.stack((cost * 3, cost * 3 - 1, cost * 3 - 2), axis=-1), 0, 1)
+
+
+def timed(stats, stage):
+    """'stats.timer(stage)' or a no-op context when instrumentation is disabled"""
+
+    return _DISABLED if stats is None else stats.timer(stage)
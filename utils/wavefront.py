@@ -0,0 +1,446 @@
+import numpy as np
+
+from utils.rt import FOV, LIGHTS, SPHERES, vector3_to_nparray
+from utils.stats import timed
+
+# Bump when a change alters the rendered pixels, it invalidates cached frames
+ENGINE_VERSION = 1
+
+BACKGROUND = np.array([0.2, 0.7, 0.8])
+MAX_DEPTH = 4
+EPSILON = 0.001
+# Hits further than this are treated as misses, as in 'rt.scene_intersect'
+MAX_DISTANCE = 1000
+
+# Primary rays traced together, every generation can double the queue
+PIXELS_PER_WAVE = 1 << 15
+
+
+def normalize_rows(vectors):
+    # multiply by the reciprocal like 'Vector3.normalized', so that rays grazing
+    # the edges of the plane fall on the same side as in 'rt'
+    return vectors * (1.0 / np.linalg.norm(vectors, axis=-1, keepdims=True))
+
+
+def dot_rows(a, b):
+    return np.einsum("ij,ij->i", a, b)
+
+
+def reflect_rows(I, N):
+    return I - N * (2.0 * dot_rows(I, N))[:, np.newaxis]
+
+
+def refract_rows(I, N, eta_t, eta_i=1.0):
+    """Vectorized 'rt.refract' for (N, 3) directions and normals"""
+
+    cosi = -np.clip(dot_rows(I, N), -1.0, 1.0)
+    # rays leaving the object: flip the normal and swap the indices
+    inside = cosi < 0
+    cosi = np.where(inside, -cosi, cosi)
+    N = np.where(inside[:, np.newaxis], -N, N)
+    eta = np.where(inside, eta_t / eta_i, eta_i / eta_t)
+
+    k = 1 - eta * eta * (1 - cosi * cosi)
+    refracted = (
+        I * eta[:, np.newaxis]
+        + N * (eta * cosi - np.sqrt(np.maximum(k, 0)))[:, np.newaxis]
+    )
+    refracted[k < 0] = (1, 0, 0)
+    return refracted
+
+
+class WhittedScene:
+    """'rt.SPHERES', the checkerboard plane and 'rt.LIGHTS' packed into arrays.
+
+    All rays and shading of the scene are computed in 'dtype'. EPSILON needs
+    no change for float32: at the largest hit distances of the scene (~30)
+    the rounding error of a hit point is still ~1e-5
+    """
+
+    def __init__(self, spheres=SPHERES, lights=LIGHTS, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        materials = []
+        for sphere in spheres:
+            if sphere.material not in materials:
+                materials.append(sphere.material)
+
+        self.centers = np.array(
+            [vector3_to_nparray(s.center) for s in spheres], dtype=self.dtype
+        )
+        self.radii = np.array([s.radius for s in spheres], dtype=self.dtype)
+        self.material_index = np.array([materials.index(s.material) for s in spheres])
+        self.lights = np.array(
+            [vector3_to_nparray(light) for light in lights], dtype=self.dtype
+        )
+        self.background = BACKGROUND.astype(self.dtype)
+
+        # the last material belongs to the plane, its color is the checkerboard
+        self.plane_material = len(materials)
+        self.albedo = np.array(
+            [m.albedo for m in materials] + [(2, 0, 0, 0)], dtype=self.dtype
+        )
+        self.diffuse_color = np.array(
+            [vector3_to_nparray(m.diffuse_color) for m in materials] + [(0, 0, 0)],
+            dtype=self.dtype,
+        )
+        self.refractive_index = np.array(
+            [m.refractive_index for m in materials] + [1.0], dtype=self.dtype
+        )
+        self.specular_exponent = np.array(
+            [m.specular_exponent for m in materials] + [0.0], dtype=self.dtype
+        )
+
+    def content(self):
+        """Arrays that determine how the scene renders, for cache keys"""
+
+        return (
+            self.centers,
+            self.radii,
+            self.material_index,
+            self.lights,
+            self.albedo,
+            self.diffuse_color,
+            self.refractive_index,
+            self.specular_exponent,
+        )
+
+    def intersect(self, origins, directions):
+        """Nearest hit of every ray as (hit, distance, point, normal, material, color)"""
+
+        count = len(origins)
+        nearest_dist = np.full(count, 1e10, dtype=self.dtype)
+        material = np.full(count, -1)
+        normal = np.zeros((count, 3), dtype=self.dtype)
+
+        # checkerboard plane y = -4
+        dy = directions[:, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = -(origins[:, 1] + 4) / dy
+            p = origins + directions * d[:, np.newaxis]
+        on_plane = (
+            (np.abs(dy) > 0.001)
+            & (d > EPSILON)
+            & (np.abs(p[:, 0]) < 10)
+            & (p[:, 2] < -10)
+            & (p[:, 2] > -30)
+        )
+        nearest_dist[on_plane] = d[on_plane]
+        material[on_plane] = self.plane_material
+        normal[on_plane] = (0, 1, 0)
+
+        # spheres, all (ray, sphere) pairs at once
+        L = self.centers[np.newaxis, :, :] - origins[:, np.newaxis, :]
+        tca = np.einsum("rsk,rk->rs", L, directions)
+        d2 = np.einsum("rsk,rsk->rs", L, L) - tca * tca
+        thc = np.sqrt(np.maximum(self.radii**2 - d2, 0))
+        t0, t1 = tca - thc, tca + thc
+        t = np.where(t0 > EPSILON, t0, np.where(t1 > EPSILON, t1, np.inf))
+        t[d2 > self.radii**2] = np.inf
+
+        sphere = np.argmin(t, axis=1)
+        sphere_dist = t[np.arange(count), sphere]
+        closer = sphere_dist <= nearest_dist
+        nearest_dist[closer] = sphere_dist[closer]
+        material[closer] = self.material_index[sphere[closer]]
+
+        point = origins + directions * nearest_dist[:, np.newaxis]
+        normal[closer] = normalize_rows(point[closer] - self.centers[sphere[closer]])
+
+        color = self.diffuse_color[material]
+        on_plane &= ~closer
+        checker = (
+            np.trunc(0.5 * point[on_plane, 0] + 1000).astype(int)
+            + np.trunc(0.5 * point[on_plane, 2]).astype(int)
+        ) & 1
+        color[on_plane] = np.where(
+            checker[:, np.newaxis], (0.3, 0.3, 0.3), (0.3, 0.2, 0.1)
+        )
+
+        hit = nearest_dist < MAX_DISTANCE
+        return hit, nearest_dist, point, normal, material, color
+
+    def occluded(self, origins, directions, max_distance, cost=None):
+        """Whether every ray hits the plane or a sphere in (EPSILON, max_distance).
+
+        Any-hit query for shadow rays: the plane is tested first, then one
+        sphere after the other on the rays not blocked yet. Builds no hit
+        points, normals or colors. Tests per ray are added to 'cost' if given
+        """
+
+        max_distance = np.minimum(max_distance, MAX_DISTANCE)
+        if cost is not None:
+            cost += 1
+
+        dy = directions[:, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = -(origins[:, 1] + 4) / dy
+            p = origins + directions * d[:, np.newaxis]
+        blocked = (
+            (np.abs(dy) > 0.001)
+            & (d > EPSILON)
+            & (d < max_distance)
+            & (np.abs(p[:, 0]) < 10)
+            & (p[:, 2] < -10)
+            & (p[:, 2] > -30)
+        )
+
+        rays = np.flatnonzero(~blocked)
+        for center, radius in zip(self.centers, self.radii):
+            if len(rays) == 0:
+                break
+            if cost is not None:
+                cost[rays] += 1
+
+            L = center - origins[rays]
+            tca = dot_rows(L, directions[rays])
+            d2 = dot_rows(L, L) - tca * tca
+            thc = np.sqrt(np.maximum(radius**2 - d2, 0))
+            t0, t1 = tca - thc, tca + thc
+            t = np.where(t0 > EPSILON, t0, np.where(t1 > EPSILON, t1, np.inf))
+            hit = (d2 <= radius**2) & (t < max_distance[rays])
+            blocked[rays[hit]] = True
+            rays = rays[~hit]
+        return blocked
+
+
+def trace_rays(
+    origins,
+    directions,
+    scene=None,
+    stats=None,
+    cost=None,
+    hit_ids=None,
+    pruning=None,
+    rng=None,
+):
+    """Whitted ray tracing of a batch of rays, one bounce generation at a time.
+
+    Instead of recursing like 'rt.cast_ray', every generation is a queue of
+    rays (origin, direction, weight, pixel): a hit adds its weighted local
+    shading to its pixel and queues a reflection and a refraction ray whose
+    weights are multiplied by the corresponding albedo. Rays of zero weight
+    are not queued, with a RayPruning 'pruning' neither are rays of low
+    weight ('rng' draws the Russian roulette). With a RenderStats
+    'stats' rays and tests are counted, tests per ray are added to 'cost'
+    if given.
+    The material first hit by every ray (-1 for none) is written to
+    'hit_ids' if given, every object of the default scene has its own
+    """
+
+    if scene is None:
+        scene = WhittedScene()
+    if stats is not None and cost is None:
+        # the tests of every ray are counted anyway, keep them in a scratch array
+        cost = np.zeros(len(origins), dtype=int)
+
+    colors = np.zeros((len(origins), 3), dtype=scene.dtype)
+    for start in range(0, len(origins), PIXELS_PER_WAVE):
+        stop = min(start + PIXELS_PER_WAVE, len(origins))
+        colors[start:stop] = _trace_wave(
+            origins[start:stop],
+            directions[start:stop],
+            scene,
+            stats,
+            None if cost is None else cost[start:stop],
+            None if hit_ids is None else hit_ids[start:stop],
+            pruning,
+            rng,
+        )
+    return colors
+
+
+def _trace_wave(origins, directions, scene, stats, cost, hit_ids, pruning, rng):
+    colors = np.zeros((len(origins), 3), dtype=scene.dtype)
+    pixel = np.arange(len(origins))
+    weight = np.ones(len(origins), dtype=scene.dtype)
+    refracted = np.zeros(len(origins), dtype=bool)
+    # plane and spheres are tested for every ray
+    tests = len(scene.centers) + 1
+
+    for depth in range(MAX_DEPTH + 2):
+        if len(pixel) == 0:
+            break
+
+        with timed(stats, "intersect"):
+            hit, _, point, N, material, diffuse_color = scene.intersect(
+                origins, directions
+            )
+        if stats is not None:
+            _count_generation(stats, depth, hit, refracted, tests)
+            np.add.at(cost, pixel, tests)
+        if depth == 0 and hit_ids is not None:
+            hit_ids[:] = np.where(hit, material, -1)
+
+        done = ~hit if depth <= MAX_DEPTH else np.ones(len(pixel), dtype=bool)
+        np.add.at(colors, pixel[done], weight[done, np.newaxis] * scene.background)
+
+        queued = ~done
+        pixel, weight, directions = pixel[queued], weight[queued], directions[queued]
+        point, N, material = point[queued], N[queued], material[queued]
+        diffuse_color = diffuse_color[queued]
+        if len(pixel) == 0:
+            break
+
+        albedo = scene.albedo[material]
+        specular_exponent = scene.specular_exponent[material]
+
+        diffuse_light_intensity = np.zeros(len(pixel), dtype=scene.dtype)
+        specular_light_intensity = np.zeros(len(pixel), dtype=scene.dtype)
+        for light in scene.lights:
+            light_dir = normalize_rows(light - point)
+            with timed(stats, "shadow"):
+                ray_tests = None if stats is None else np.zeros(len(pixel), dtype=int)
+                lit = ~scene.occluded(
+                    point, light_dir, np.linalg.norm(light - point, axis=1), ray_tests
+                )
+            if stats is not None:
+                blocked = len(pixel) - np.count_nonzero(lit)
+                stats.count("shadow", len(pixel), blocked, ray_tests.sum())
+                np.add.at(cost, pixel, ray_tests)
+
+            diffuse_light_intensity += np.where(
+                lit, np.maximum(0.0, dot_rows(light_dir, N)), 0
+            )
+            specular_light_intensity += np.where(
+                lit,
+                np.maximum(0.0, -dot_rows(reflect_rows(-light_dir, N), directions))
+                ** specular_exponent,
+                0,
+            )
+
+        local = (
+            diffuse_color * (diffuse_light_intensity * albedo[:, 0])[:, np.newaxis]
+            + (specular_light_intensity * albedo[:, 1])[:, np.newaxis]
+        )
+        np.add.at(colors, pixel, weight[:, np.newaxis] * local)
+
+        reflect_weight = weight * albedo[:, 2]
+        refract_weight = weight * albedo[:, 3]
+        if pruning is None:
+            reflecting, refracting = reflect_weight > 0, refract_weight > 0
+        else:
+            reflecting, scale = pruning.survivors(reflect_weight, rng)
+            reflect_weight *= scale
+            refracting, scale = pruning.survivors(refract_weight, rng)
+            refract_weight *= scale
+
+        reflect_dir = normalize_rows(
+            reflect_rows(directions[reflecting], N[reflecting])
+        )
+        refract_dir = normalize_rows(
+            refract_rows(
+                directions[refracting],
+                N[refracting],
+                scene.refractive_index[material[refracting]],
+            )
+        )
+        origins = np.concatenate((point[reflecting], point[refracting]))
+        directions = np.concatenate((reflect_dir, refract_dir))
+        weight = np.concatenate(
+            (reflect_weight[reflecting], refract_weight[refracting])
+        )
+        refracted = np.repeat((False, True), (len(reflect_dir), len(refract_dir)))
+        pixel = np.concatenate((pixel[reflecting], pixel[refracting]))
+
+    return colors
+
+
+def _count_generation(stats, depth, hit, refracted, tests):
+    if depth == 0:
+        stats.count("primary", len(hit), np.count_nonzero(hit), len(hit) * tests, 0)
+        return
+
+    for kind, rays in (("reflection", ~refracted), ("refraction", refracted)):
+        count = np.count_nonzero(rays)
+        stats.count(kind, count, np.count_nonzero(hit & rays), count * tests, depth)
+
+
+def primary_rays(
+    width, height, top=0, left=0, bottom=None, right=None, fov=FOV, dtype=np.float64
+):
+    """Camera rays of 'rt.render_tile' for pixels [top:bottom, left:right]"""
+
+    bottom = height if bottom is None else bottom
+    right = width if right is None else right
+
+    i, j = np.mgrid[top:bottom, left:right]
+    directions = np.empty(i.shape + (3,), dtype=dtype)
+    directions[..., 0] = (j + 0.5) - width / 2
+    directions[..., 1] = -(i + 0.5) + height / 2
+    directions[..., 2] = -height / (2.0 * np.tan(fov / 2.0))
+
+    directions = normalize_rows(directions.reshape(-1, 3))
+    return np.zeros_like(directions), directions
+
+
+def sample_rays(width, height, rows, cols, fov=FOV, dtype=np.float64):
+    """Camera rays through fractional pixel coordinates, pixel centers are at +0.5"""
+
+    directions = np.empty((len(rows), 3), dtype=dtype)
+    directions[:, 0] = (cols + 0.5) - width / 2
+    directions[:, 1] = -(rows + 0.5) + height / 2
+    directions[:, 2] = -height / (2.0 * np.tan(fov / 2.0))
+
+    directions = normalize_rows(directions)
+    return np.zeros_like(directions), directions
+
+
+def render_samples(width, height, rows, cols, fov=FOV, scene=None, pruning=None):
+    """(N, 3) colors of the rays through the (fractional) pixel coordinates (rows, cols)"""
+
+    if scene is None:
+        scene = WhittedScene()
+    rng = None if pruning is None else pruning.generator(int(rows[0]), int(cols[0]))
+    origins, directions = sample_rays(width, height, rows, cols, fov, scene.dtype)
+    return trace_rays(origins, directions, scene, pruning=pruning, rng=rng)
+
+
+def render_tile(
+    width,
+    height,
+    top,
+    left,
+    bottom,
+    right,
+    fov=FOV,
+    scene=None,
+    stats=None,
+    antialias=None,
+    pruning=None,
+):
+    """Wavefront counterpart of 'rt.render_tile', in the precision of 'scene'.
+
+    With an AdaptiveAA 'antialias' edge pixels are supersampled, with a
+    RayPruning 'pruning' low contribution rays are terminated
+    """
+
+    if scene is None:
+        scene = WhittedScene()
+    rng = None if pruning is None else pruning.generator(top, left)
+    if antialias is not None:
+
+        def sample(rows, cols):
+            origins, directions = sample_rays(
+                width, height, rows, cols, fov, scene.dtype
+            )
+            cost = None if stats is None else np.zeros(len(origins))
+            ids = np.empty(len(origins), dtype=int)
+            colors = trace_rays(
+                origins, directions, scene, stats, cost, ids, pruning, rng
+            )
+            if stats is not None:
+                stats.add_sample_cost(rows, cols, cost)
+            return colors, ids
+
+        return antialias.render(sample, width, height, top, left, bottom, right)
+
+    with timed(stats, "primary rays"):
+        origins, directions = primary_rays(
+            width, height, top, left, bottom, right, fov, scene.dtype
+        )
+
+    cost = None if stats is None else np.zeros(len(origins))
+    colors = trace_rays(origins, directions, scene, stats, cost, None, pruning, rng)
+    if stats is not None:
+        stats.add_cost(top, left, cost.reshape(bottom - top, right - left))
+    return colors.reshape(bottom - top, right - left, 3)
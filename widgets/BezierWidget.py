@@ -1,6 +1,7 @@
 from PySide6.QtWidgets import *
 from PySide6.QtCore import *
 from PySide6.QtGui import *
+import numpy as np
 import utils.splines as spl
 
 VISUALIZATION_BG_COLOR = (50, 50, 50)
@@ -17,6 +18,7 @@ SPINBOX_STEP = 0.1
 MINIMUM_POINTS = 3
 MAXIMUM_POINTS = 15
 SCALE_VELOCITY = 4
+FLATNESS_TOLERANCE = 0.25  # in pixels, for adaptive flattening
 
 
 class BezierMenuWidget(QWidget):
@@ -45,6 +47,10 @@ class BezierMenuWidget(QWidget):
         self.Layout.addWidget(QLabel("Number of points:"))
         self.Layout.addWidget(self.num_of_points)
 
+        self.adaptive = QCheckBox("Adaptive flattening")
+        self.adaptive.toggled.connect(self.adaptiveToggled)
+        self.Layout.addWidget(self.adaptive)
+
         self.pointsWidget = QWidget()
         self.pointsLayout = QGridLayout(spacing=10)
 
@@ -106,6 +112,11 @@ class BezierMenuWidget(QWidget):
 
             self.pointsLayout.addWidget(self.points[i], cur_row, i % 2 + 1)
 
+    def adaptiveToggled(self):
+        """Called when adaptive flattening has been turned on or off"""
+
+        self._sibling.setAdaptive(self.adaptive.isChecked())
+
     def boxToggled(self):
         """Called when any point has been disabled by clicking on check box"""
 
@@ -144,11 +155,29 @@ class BezierMenuWidget(QWidget):
                     [self.points[i * 2].value(), self.points[i * 2 + 1].value()]
                 )
 
+    def changedCoordinate(self):
+        """Index in 'coords' of the point whose spin box sent the signal, or None"""
+
+        if len(self.points) != self.num_of_points.value() * 2:
+            return None
+
+        sender = self.sender()
+        for i, point in enumerate(self.points):
+            if point is sender:
+                if not self.toggled[i // 2]:
+                    return None
+                return sum(self.toggled[: i // 2])
+        return None
+
     def anyPointChanged(self):
         """Called when any point has been changed"""
 
+        index = self.changedCoordinate()
         self.updateCoordinates()
-        self._sibling.setCoords(self.coords)
+        if index is None:
+            self._sibling.setCoords(self.coords)
+        else:
+            self._sibling.moveCoord(index, self.coords[index])
 
 
 class BezierVisualizationWidget(QWidget):
@@ -171,6 +200,8 @@ class BezierVisualizationWidget(QWidget):
         self.bezier = []
 
         self.scale = 25
+        self.adaptive = False
+        self._paths = None
         self._sibling = None
 
     def setSibling(self, s):
@@ -201,15 +232,48 @@ class BezierVisualizationWidget(QWidget):
         if self.scale < 1:
             self.scale = 1
 
+        if self.adaptive:
+            self.calculate_bezier()
+        self.invalidate()
         self.update()
 
     def setCoords(self, coords):
         """Set new coordinates for bezier spline calculation and calculate new bezier spline"""
 
-        self.coords = coords
+        self.coords = [list(coord) for coord in coords]
+        self.calculate_bezier()
+        self.invalidate()
+        self.update()
+
+    def moveCoord(self, index, coord):
+        """Move a single point, uniformly sampled curves are updated incrementally"""
+
+        if self.adaptive or len(self.bezier) == 0 or index >= len(self.coords):
+            coords = [list(c) for c in self.coords]
+            if index < len(coords):
+                coords[index] = list(coord)
+            self.setCoords(coords)
+            return
+
+        delta = np.subtract(coord, self.coords[index])
+        self.coords[index] = list(coord)
+        spl.bezier_move_point(self.bezier, len(self.coords) - 1, index, delta)
+        self.invalidate()
+        self.update()
+
+    def setAdaptive(self, adaptive):
+        """Switch between fixed uniform sampling and adaptive flattening"""
+
+        self.adaptive = adaptive
         self.calculate_bezier()
+        self.invalidate()
         self.update()
 
+    def resizeEvent(self, event):
+        """Origin moves with the widget size, so cached paths are outdated"""
+
+        self.invalidate()
+
     def paintEvent(self, event):
         """Default paint event that draws coordinate system and caclulated figures"""
 
@@ -228,43 +292,52 @@ class BezierVisualizationWidget(QWidget):
     def draw_points(self, painter):
         """Draw points of bezier spline that stored in 'bezier' list"""
 
+        if self._paths is None:
+            self._paths = (self.to_device(self.bezier), self.to_device(self.coords))
+        curve, control = self._paths
+
         pen = QPen()
         pen.setColor(QColor(qRgb(*SPLINE_COLOR)))
         pen.setWidth(PEN_WIDTH)
         painter.setPen(pen)
-
-        for i in range(1, len(self.bezier) - 1):
-            painter.drawLine(
-                self.ORIGIN[0] + self.bezier[i][0] * self.scale,
-                self.ORIGIN[1] - self.bezier[i][1] * self.scale,
-                self.ORIGIN[0] + self.bezier[i + 1][0] * self.scale,
-                self.ORIGIN[1] - self.bezier[i + 1][1] * self.scale,
-            )
+        painter.drawPolyline(curve)
 
         pen.setColor(QColor(qRgb(*POINT_COLOR)))
         pen.setWidth(PEN_WIDTH + 4)
         painter.setPen(pen)
-
-        for coord in self.coords:
-            painter.drawPoint(
-                self.ORIGIN[0] + coord[0] * self.scale,
-                self.ORIGIN[1] - coord[1] * self.scale,
-            )
+        painter.drawPoints(control)
 
         pen.setWidth(PEN_WIDTH)
         painter.setPen(pen)
-        for i in range(len(self.coords) - 1):
-            painter.drawLine(
-                self.ORIGIN[0] + self.coords[i][0] * self.scale,
-                self.ORIGIN[1] - self.coords[i][1] * self.scale,
-                self.ORIGIN[0] + self.coords[i + 1][0] * self.scale,
-                self.ORIGIN[1] - self.coords[i + 1][1] * self.scale,
-            )
+        painter.drawPolyline(control)
+
+    def to_device(self, coords):
+        """Transform curve coordinates to a polygon in widget pixels"""
+
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        device = np.empty_like(coords)
+        device[:, 0] = self.ORIGIN[0] + coords[:, 0] * self.scale
+        device[:, 1] = self.ORIGIN[1] - coords[:, 1] * self.scale
+        return QPolygonF([QPointF(x, y) for x, y in device.tolist()])
+
+    def invalidate(self):
+        """Drop cached device space paths, they are rebuilt on the next paint"""
+
+        self._paths = None
 
     def calculate_bezier(self):
-        """Calculate bezier spline points using algorithm from utils.py"""
+        """Calculate bezier spline points using algorithm from utils.py.
+
+        Adaptive flattening emits just enough points for the curve to stay
+        within FLATNESS_TOLERANCE pixels at the current scale
+        """
 
-        self.bezier = spl.bezier(self.coords)
+        if self.adaptive:
+            self.bezier = spl.bezier_adaptive(
+                self.coords, FLATNESS_TOLERANCE / self.scale
+            )
+        else:
+            self.bezier = spl.bezier(self.coords)
 
     def draw_coordinate_system(self, painter):
         """Method that draws coordinate system"""
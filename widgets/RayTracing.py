@@ -1,10 +1,115 @@
-from time import time
 from PySide6.QtWidgets import *
 from PySide6.QtCore import *
 from PySide6.QtGui import *
-from PIL import Image
-from utils.raytracing import render_image
-import os
+from time import perf_counter
+import numpy as np
+from utils.antialias import AdaptiveAA
+from utils.backends import BACKENDS
+from utils.cache import DEFAULT_DIRECTORY, RenderCache
+from utils.preview import PREVIEW_SCALES, render_levels, upscaled
+
+
+def to_rgb8(image, out=None):
+    """Convert a float RGB image in [0, 1] to uint8 in one vectorized pass"""
+
+    if out is None:
+        out = np.empty(image.shape, dtype=np.uint8)
+    # float32 scratch halves the memory traffic of the float64 frame
+    scaled = np.multiply(image, 255, dtype=np.float32)
+    np.clip(scaled, 0, 255, out=scaled)
+    scaled += 0.5
+    np.copyto(out, scaled, casting="unsafe")
+    return out
+
+
+class FrameBuffer:
+    """uint8 RGB pixels and a QImage that wraps them without copying.
+
+    QImage does not own the wrapped memory, so the image must only be used
+    while the FrameBuffer (and with it 'pixels') is alive
+    """
+
+    def __init__(self, width, height):
+        self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        self.image = QImage(
+            self.pixels.data, width, height, 3 * width, QImage.Format_RGB888
+        )
+
+    @classmethod
+    def from_array(cls, image):
+        frame = cls(image.shape[1], image.shape[0])
+        to_rgb8(image, out=frame.pixels)
+        return frame
+
+    def write(self, top, left, tile):
+        """Convert a float tile straight into the shared pixels"""
+
+        height, width = tile.shape[:2]
+        to_rgb8(tile, out=self.pixels[top : top + height, left : left + width])
+
+
+class RenderWorker(QThread):
+    """Renders a frame tile by tile in a background thread and streams the tiles"""
+
+    tileRendered = Signal(int, int, object)
+    frameRendered = Signal(float)
+    renderFailed = Signal(str)
+
+    def __init__(self, parent, backend, width, height):
+        super().__init__(parent)
+
+        self.backend = backend
+        self.frame_width = width
+        self.frame_height = height
+
+    def run(self):
+        # nothing above the thread would see the exception
+        try:
+            self._render()
+        except Exception as error:
+            self.renderFailed.emit(f"{type(error).__name__}: {error}")
+
+    def _render(self):
+        start = perf_counter()
+        if self._emit_tiles():
+            self.frameRendered.emit(perf_counter() - start)
+
+    def _emit_tiles(self):
+        """Render and send the tiles of the frame, False when interrupted"""
+
+        for top, left, tile in self.backend.render_tiles(
+            self.frame_width, self.frame_height
+        ):
+            if self.isInterruptionRequested():
+                return False
+            self.tileRendered.emit(top, left, tile)
+        return True
+
+
+class PreviewWorker(RenderWorker):
+    """Renders a frame coarse to fine, see 'utils.preview.render_levels'.
+
+    Every finished level is sent upscaled to the frame size. With
+    anti-aliasing the full resolution level is the tile render of
+    RenderWorker, drawn over the last preview
+    """
+
+    levelRendered = Signal(int, object)
+
+    def _render(self):
+        start = perf_counter()
+        antialias = getattr(self.backend, "antialias", None)
+        scales = PREVIEW_SCALES if antialias is None else PREVIEW_SCALES[:-1]
+        for scale, frame, done in render_levels(
+            self.backend.render_samples, self.frame_width, self.frame_height, scales
+        ):
+            if self.isInterruptionRequested():
+                return
+            if done:
+                self.levelRendered.emit(scale, upscaled(frame, scale))
+
+        if antialias is None or self._emit_tiles():
+            self.frameRendered.emit(perf_counter() - start)
 
 
 class RayTracingMenuWidget(QWidget):
@@ -19,9 +124,27 @@ class RayTracingMenuWidget(QWidget):
     def initUI(self):
         self.Layout = QFormLayout(spacing=10)
 
-        self.load_button = QPushButton("Load ray tracing")
-        self.load_button.clicked.connect(self.load)
-        self.Layout.addWidget(self.load_button)
+        self.backend_combo = QComboBox()
+        self.backend_combo.addItems([backend.name for backend in BACKENDS])
+        self.backend_combo.activated.connect(self.backendChanged)
+        self.Layout.addWidget(QLabel("Renderer:"))
+        self.Layout.addWidget(self.backend_combo)
+
+        self.antialias = QCheckBox("Anti-aliasing")
+        self.antialias.toggled.connect(self.antialiasToggled)
+        self.Layout.addWidget(self.antialias)
+
+        self.preview = QCheckBox("Low resolution preview")
+        self.preview.toggled.connect(self.previewToggled)
+        self.Layout.addWidget(self.preview)
+
+        self.render_button = QPushButton("Render")
+        self.render_button.clicked.connect(self.render)
+        self.Layout.addWidget(self.render_button)
+
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel)
+        self.Layout.addWidget(self.cancel_button)
 
         self.setLayout(self.Layout)
 
@@ -30,9 +153,28 @@ class RayTracingMenuWidget(QWidget):
     def setSibling(self, s):
         self._sibling = s
 
-    def load(self):
+    def backendChanged(self):
+        backend = BACKENDS[self.backend_combo.currentIndex()]
+        self.antialias.setEnabled(backend.antialiasing)
+        self.preview.setEnabled(backend.previews)
+        if self._sibling:
+            self._sibling.setBackend(backend())
+
+    def antialiasToggled(self, checked):
         if self._sibling:
-            self._sibling.load()
+            self._sibling.setAntialias(checked)
+
+    def previewToggled(self, checked):
+        if self._sibling:
+            self._sibling.setPreview(checked)
+
+    def render(self):
+        if self._sibling:
+            self._sibling.render()
+
+    def cancel(self):
+        if self._sibling:
+            self._sibling.cancel()
 
 
 class RayTracingVisualizationWidget(QWidget):
@@ -46,39 +188,151 @@ class RayTracingVisualizationWidget(QWidget):
 
     def initUI(self):
         self.rendered = None
+        self.frame = None
+        self.worker = None
+        self.backend = BACKENDS[0]()
+        self.antialias = None
+        self.preview = False
+        self.cache = RenderCache(directory=DEFAULT_DIRECTORY)
+        self._cache_key = None
+        self._workers = set()
 
         self._sibling = None
 
     def setSibling(self, s):
         self._sibling = s
 
-    def load(self):
-        start = time()
-        os.system("cd ../RayTracing/build/Debug/ && tinyraytracer")
+    def setBackend(self, backend):
+        """Use another render backend, the current frame is rendered again"""
 
-        im = Image.open("utils/out.ppm")
-        im.save("utils/out.png")
+        self.backend = backend
+        if backend.antialiasing:
+            backend.antialias = self.antialias
+        if self.frame is not None:
+            self.rendered = None
+            self.render()
 
-        self.pic = QLabel(self)
-        self.pic.setPixmap(QPixmap("utils/out.png"))
+    def setAntialias(self, enabled):
+        """Turn adaptive anti-aliasing on or off for backends that support it"""
 
-        self.pic.show()
-        print(time() - start)
+        self.antialias = AdaptiveAA() if enabled else None
+        self.setBackend(self.backend)
 
-    def paintEvent(self, event):
-        pass
+    def setPreview(self, enabled):
+        """Show frames at 1/8, 1/4 and 1/2 resolution before the full one.
+
+        Only for backends with 'previews', starting from the next render
+        """
+
+        self.preview = enabled
 
     def render(self):
-        if not self.rendered:
-            self.rendered = render_image(self.width(), self.height())
-            for i in range(self.pixmap.width()):
-                for j in range(self.pixmap.height()):
-                    self.pixmap.setPixel(
-                        i,
-                        j,
-                        QColor(
-                            self.rendered[i][j][0],
-                            self.rendered[i][j][1],
-                            self.rendered[i][j][2],
-                        ).rgb(),
-                    )
+        """Start rendering the frame in background, tiles are shown as they are ready.
+
+        In preview mode the levels of detail are shown instead, a new render
+        (a resize, another backend or option) cancels the remaining ones
+        """
+
+        if self.rendered is not None and self.rendered.shape[:2] == (
+            self.height(),
+            self.width(),
+        ):
+            return
+
+        self.cancel()
+
+        self._cache_key = self.backend.cache_key(self.width(), self.height())
+        if self._cache_key is not None:
+            cached = self.cache.get(self._cache_key)
+            if cached is not None:
+                self.rendered = cached
+                self.frame = FrameBuffer.from_array(cached)
+                self.update()
+                print(f"{self.backend.name}: cached, {self.cache.report()}")
+                return
+
+        self.rendered = None
+        self.frame = FrameBuffer(self.width(), self.height())
+        if self.antialias is not None:
+            self.antialias.reset_stats()
+        self._framebuffer = np.zeros((self.height(), self.width(), 3))
+
+        if self.preview and self.backend.previews:
+            self._start(PreviewWorker(self, self.backend, self.width(), self.height()))
+        else:
+            self._start(RenderWorker(self, self.backend, self.width(), self.height()))
+
+    def cancel(self):
+        """Stop the render in progress, tiles that are already shown are kept"""
+
+        if self.worker is not None:
+            self.worker.requestInterruption()
+            self.worker = None
+
+    def _start(self, worker):
+        # Keep references to workers until they have actually finished
+        self.worker = worker
+        self._workers.add(worker)
+        worker.finished.connect(lambda: self._workers.discard(worker))
+        # signals emitted before they are connected are lost
+        worker.tileRendered.connect(self.tileRendered)
+        worker.frameRendered.connect(self.frameRendered)
+        worker.renderFailed.connect(self.renderFailed)
+        if isinstance(worker, PreviewWorker):
+            worker.levelRendered.connect(self.levelRendered)
+        worker.start()
+
+    def tileRendered(self, top, left, tile):
+        if self.sender() is not self.worker:
+            return
+
+        # External renderers may produce frames of another size
+        tile = tile[: self.height() - top, : self.width() - left]
+        height, width = tile.shape[:2]
+        self._framebuffer[top : top + height, left : left + width] = tile
+        self.frame.write(top, left, tile)
+        self.update(left, top, width, height)
+
+    def levelRendered(self, scale, image):
+        if self.sender() is not self.worker:
+            return
+
+        # tiles of an anti-aliased frame are drawn over the last level
+        self._framebuffer = image
+        self.frame.write(0, 0, image)
+        self.update()
+
+    def renderFailed(self, message):
+        if self.sender() is not self.worker:
+            return
+
+        print(f"{self.backend.name}: {message}")
+
+    def frameRendered(self, elapsed):
+        if self.sender() is not self.worker:
+            return
+
+        self.rendered = self._framebuffer
+        print(f"{self.backend.name}: {elapsed:.3f} s")
+        if self.antialias is not None and self.backend.antialiasing:
+            print(self.antialias.report())
+        if self._cache_key is not None:
+            self.cache.put(self._cache_key, self.rendered)
+            print(self.cache.report())
+
+    def resizeEvent(self, event):
+        """Restart the render for the new size if there is one in progress or shown"""
+
+        if self.frame is not None and (
+            self.rendered is not None or isinstance(self.worker, RenderWorker)
+        ):
+            self.rendered = None
+            self.render()
+
+    def paintEvent(self, event):
+        if self.frame is None:
+            return
+
+        painter = QPainter(self)
+        painter.drawImage(0, 0, self.frame.image)
+        painter.end()